@@ -4,14 +4,19 @@ import os
 import aws_cdk as cdk
 
 from geolite.geolite_download import GeoliteDownload
-from geolite.geolite_searchuse1 import GeoliteSearchUSE1
-from geolite.geolite_searchusw2 import GeoliteSearchUSW2
+from geolite.geolite_search import GeoliteSearch
 from geolite.geolite_stack import GeoliteStack
 
 app = cdk.App()
 
+regions = {
+    'us-east-1': 'use1',
+    'us-west-2': 'usw2'
+}
+
 GeoliteDownload(
     app, 'GeoliteDownload',
+    regions = regions,
     env = cdk.Environment(
         account = os.getenv('CDK_DEFAULT_ACCOUNT'),
         region = 'us-east-2'
@@ -21,27 +26,19 @@ GeoliteDownload(
     )
 )
 
-GeoliteSearchUSE1(
-    app, 'GeoliteSearchUSE1',
-    env = cdk.Environment(
-        account = os.getenv('CDK_DEFAULT_ACCOUNT'),
-        region = 'us-east-1'
-    ),
-    synthesizer = cdk.DefaultStackSynthesizer(
-        qualifier = 'lukach'
-    )
-)
-
-GeoliteSearchUSW2(
-    app, 'GeoliteSearchUSW2',
-    env = cdk.Environment(
-        account = os.getenv('CDK_DEFAULT_ACCOUNT'),
-        region = 'us-west-2'
-    ),
-    synthesizer = cdk.DefaultStackSynthesizer(
-        qualifier = 'lukach'
+for region, code in regions.items():
+
+    GeoliteSearch(
+        app, 'GeoliteSearch'+code.upper(),
+        code = code,
+        env = cdk.Environment(
+            account = os.getenv('CDK_DEFAULT_ACCOUNT'),
+            region = region
+        ),
+        synthesizer = cdk.DefaultStackSynthesizer(
+            qualifier = 'lukach'
+        )
     )
-)
 
 GeoliteStack(
     app, 'GeoliteStack',
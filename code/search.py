@@ -1,87 +1,1180 @@
-import geoip2.database
+import base64
+import bisect
+import collections
+import importlib.util
 import ipaddress
 import json
+import maxminddb
+import maxminddb.decoder
+import mmap
 import os
+import shutil
+import struct
+import threading
+import time
+import urllib.parse
 
-def handler(event, context):
+CODECS = {}
+
+try:
+    import msgpack
+    CODECS['msgpack'] = msgpack.packb
+except ImportError:
+    pass
+
+try:
+    import cbor2
+    CODECS['cbor'] = cbor2.dumps
+except ImportError:
+    pass
+
+MODES = {
+    'ext': maxminddb.MODE_MMAP_EXT,
+    'mmap': maxminddb.MODE_MMAP,
+    'memory': maxminddb.MODE_MEMORY
+}
+
+STYLES = {
+    'pretty': {'indent': 4, 'separators': (',', ': ')},
+    'plain': {'separators': (', ', ': ')},
+    'compact': {'separators': (',', ':')}
+}
+
+MEDIA = {
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+    'application/vnd.msgpack': 'msgpack',
+    'application/cbor': 'cbor'
+}
+
+CONTENT = {
+    'msgpack': 'application/msgpack',
+    'cbor': 'application/cbor'
+}
+
+FIELDS = {
+    'geo': ('country', 'c_iso', 'state', 's_iso', 'city', 'zip', 'latitude', 'longitude', 'cidr'),
+    'asn': ('id', 'org', 'net')
+}
+
+### IANA SPECIAL-PURPOSE ADDRESS REGISTRIES (NOT GLOBALLY REACHABLE) ###
+
+RESERVED = [
+    ('0.0.0.0/8', 'This Network', 'RFC791'),
+    ('10.0.0.0/8', 'Private-Use', 'RFC1918'),
+    ('100.64.0.0/10', 'Shared Address Space', 'RFC6598'),
+    ('127.0.0.0/8', 'Loopback', 'RFC1122'),
+    ('169.254.0.0/16', 'Link Local', 'RFC3927'),
+    ('172.16.0.0/12', 'Private-Use', 'RFC1918'),
+    ('192.0.0.0/24', 'IETF Protocol Assignments', 'RFC6890'),
+    ('192.0.2.0/24', 'Documentation (TEST-NET-1)', 'RFC5737'),
+    ('192.168.0.0/16', 'Private-Use', 'RFC1918'),
+    ('198.18.0.0/15', 'Benchmarking', 'RFC2544'),
+    ('198.51.100.0/24', 'Documentation (TEST-NET-2)', 'RFC5737'),
+    ('203.0.113.0/24', 'Documentation (TEST-NET-3)', 'RFC5737'),
+    ('224.0.0.0/4', 'Multicast', 'RFC5771'),
+    ('240.0.0.0/4', 'Reserved', 'RFC1112'),
+    ('::/128', 'Unspecified Address', 'RFC4291'),
+    ('::1/128', 'Loopback Address', 'RFC4291'),
+    ('64:ff9b:1::/48', 'IPv4-IPv6 Translation', 'RFC8215'),
+    ('100::/64', 'Discard-Only Address Block', 'RFC6666'),
+    ('2001:2::/48', 'Benchmarking', 'RFC5180'),
+    ('2001:db8::/32', 'Documentation', 'RFC3849'),
+    ('3fff::/20', 'Documentation', 'RFC9637'),
+    ('5f00::/16', 'Segment Routing (SRv6) SIDs', 'RFC9602'),
+    ('fc00::/7', 'Unique-Local', 'RFC4193'),
+    ('fe80::/10', 'Link-Local Unicast', 'RFC4291'),
+    ('ff00::/8', 'Multicast', 'RFC4291')
+]
+
+ENGINE = os.environ.get('GEOLITE_ENGINE', 'mmdb')
+RELOAD = int(os.environ.get('GEOLITE_RELOAD', '0'))
+BUCKET = os.environ.get('GEOLITE_BUCKET')
+BATCH_LIMIT = int(os.environ.get('GEOLITE_BATCH', '10000'))
+CACHE_SIZE = int(os.environ.get('GEOLITE_CACHE', '8192'))
+
+class Direct:
+
+    def __init__(self, path):
+
+        self.file = open(path, 'rb')
+        self.buf = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, groups, patterns, palette, entries, count = struct.unpack_from('<8sIIIII', self.buf, 0)
+        if magic != b'DIR248\x00\x03':
+            raise ValueError('Invalid DIR-24-8 table '+path)
+
+        self.tbl24 = 28
+        self.groups = self.tbl24 + 4 * 2 ** 24
+        self.patterns = self.groups + 8 * groups
+        self.palette = self.patterns + 256 * patterns
+        self.records = self.palette + 4 * palette
+        self.prefixes = self.records + 8 * entries
+        self.offsets = self.prefixes + 2 * entries + (-2 * entries % 4)
+        self.blob = self.offsets + 4 * (count + 1)
+
+    def record(self, index):
+
+        if index == 0:
+            return None
+
+        start, end = struct.unpack_from('<II', self.buf, self.offsets + 4 * (index - 1))
+
+        return json.loads(self.buf[self.blob + start:self.blob + end])
+
+    def get(self, ip):
+
+        # Returns the City and ASN fields, None for a side without data, and
+        # the prefix lengths of their networks, or None when neither has data.
+
+        value = int(ip)
+        entry = struct.unpack_from('<I', self.buf, self.tbl24 + 4 * (value >> 8))[0]
+
+        if entry & 0x80000000:
+            pattern, base = struct.unpack_from('<II', self.buf, self.groups + 8 * (entry & 0x7fffffff))
+            slot = self.buf[self.patterns + 256 * pattern + (value & 0xff)]
+            entry = struct.unpack_from('<I', self.buf, self.palette + 4 * (base + slot))[0]
+
+        if entry == 0:
+            return None
+
+        georecord, asnrecord = struct.unpack_from('<II', self.buf, self.records + 8 * (entry - 1))
+        cityprefix, asnprefix = struct.unpack_from('<BB', self.buf, self.prefixes + 2 * (entry - 1))
+
+        return self.record(georecord), cityprefix, self.record(asnrecord), asnprefix
+
+    def close(self):
+
+        self.buf.close()
+        self.file.close()
+
+class Column:
+
+    # Read-only sequence over packed uint32 values, usable with bisect.
+
+    def __init__(self, buf, offset, count):
+
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+
+        return self.count
+
+    def __getitem__(self, index):
+
+        return struct.unpack_from('<I', self.buf, self.offset + 4 * index)[0]
+
+class Names:
+
+    # Lowercase org names of the reverse index, usable with bisect.
+
+    def __init__(self, reverse):
+
+        self.reverse = reverse
+
+    def __len__(self):
+
+        return self.reverse.orgcount
+
+    def __getitem__(self, index):
+
+        return self.reverse.org(index).lower()
+
+class Reverse:
+
+    def __init__(self, path):
+
+        self.file = open(path, 'rb')
+        self.buf = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, asncount, netcount, orgcount = struct.unpack_from('<8sIII', self.buf, 0)
+        if magic != b'ASNREV\x00\x01':
+            raise ValueError('Invalid ASN reverse index '+path)
+
+        self.orgcount = orgcount
+        self.asns = Column(self.buf, 20, asncount)
+        self.first = Column(self.buf, 20 + 4 * asncount, asncount + 1)
+        self.starts = 20 + 8 * asncount + 4
+        self.prefixes = self.starts + 16 * netcount
+        self.orgasns = Column(self.buf, self.prefixes + netcount + (-netcount % 4), orgcount)
+        self.names = Column(self.buf, self.orgasns.offset + 4 * orgcount, orgcount + 1)
+        self.blob = self.names.offset + 4 * (orgcount + 1)
+
+    def org(self, index):
+
+        return self.buf[self.blob + self.names[index]:self.blob + self.names[index + 1]].decode()
+
+    def networks(self, asn):
+
+        pos = bisect.bisect_left(self.asns, asn)
+
+        if pos == len(self.asns) or self.asns[pos] != asn:
+            return []
+
+        networks = []
+
+        for index in range(self.first[pos], self.first[pos + 1]):
+            start = int.from_bytes(self.buf[self.starts + 16 * index:self.starts + 16 * (index + 1)], 'big')
+            prefixlen = self.buf[self.prefixes + index]
+            if prefixlen >= 96 and start < 2 ** 32:
+                networks.append(ipaddress.IPv4Network((start, prefixlen - 96)))
+            else:
+                networks.append(ipaddress.IPv6Network((start, prefixlen)))
+
+        return networks
+
+    def orgs(self, prefix, limit):
+
+        prefix = prefix.lower()
+        matches = []
+
+        for index in range(bisect.bisect_left(Names(self), prefix), self.orgcount):
+            org = self.org(index)
+            if not org.lower().startswith(prefix) or len(matches) == limit:
+                break
+            matches.append({'asn': self.orgasns[index], 'org': org})
+
+        return matches
+
+    def close(self):
+
+        self.buf.close()
+        self.file.close()
+
+class Tree:
+
+    # Walks one subtree of a MaxMind DB search tree in address order, so a
+    # CIDR query visits only the nodes under its prefix.
+
+    def __init__(self, path, reader):
+
+        metadata = reader.metadata()
+
+        self.file = open(path, 'rb')
+        self.buf = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.node_count = metadata.node_count
+        self.record_size = metadata.record_size
+        self.node_bytes = metadata.record_size // 4
+        self.tree_size = metadata.node_count * self.node_bytes
+        self.ip_version = metadata.ip_version
+        self.decoder = maxminddb.decoder.Decoder(self.buf, self.tree_size + 16)
+        self.records = {}
+
+        self.ipv4_start = 0
+        if self.ip_version == 6:
+            for _ in range(96):
+                if self.ipv4_start >= self.node_count:
+                    break
+                self.ipv4_start = self.read(self.ipv4_start, 0)
+
+    def read(self, node, side):
+
+        offset = node * self.node_bytes
+        buf = self.buf
+
+        if self.record_size == 24:
+            offset += side * 3
+            return (buf[offset] << 16) | (buf[offset + 1] << 8) | buf[offset + 2]
+
+        if self.record_size == 28:
+            if side == 0:
+                return ((buf[offset + 3] & 0xf0) << 20) | (buf[offset] << 16) | (buf[offset + 1] << 8) | buf[offset + 2]
+            return ((buf[offset + 3] & 0x0f) << 24) | (buf[offset + 4] << 16) | (buf[offset + 5] << 8) | buf[offset + 6]
+
+        offset += side * 4
+        return int.from_bytes(buf[offset:offset + 4], 'big')
+
+    def record(self, node):
+
+        if node not in self.records:
+            if len(self.records) >= CACHE_SIZE:
+                self.records.clear()
+            self.records[node], _ = self.decoder.decode(node - self.node_count + self.tree_size)
+
+        return self.records[node]
+
+    def walk(self, network, start):
+
+        # Yields (leaf network, record) for every leaf holding data inside
+        # network whose addresses reach start or beyond. A network inside a
+        # single leaf yields that leaf once.
+
+        bits = network.max_prefixlen
+        node = self.ipv4_start if network.version == 4 else 0
+        value = int(network.network_address)
+
+        for depth in range(network.prefixlen):
+            if node >= self.node_count:
+                break
+            node = self.read(node, (value >> (bits - 1 - depth)) & 1)
+        else:
+            depth = network.prefixlen
+
+        if node >= self.node_count:
+            if node > self.node_count:
+                yield ipaddress.ip_network((value, depth), strict = False), self.record(node)
+            return
+
+        stack = [(node, depth, value >> (bits - depth) if depth else 0)]
+
+        while stack:
+            node, depth, acc = stack.pop()
+            if acc << (bits - depth) | ((1 << (bits - depth)) - 1) < start:
+                continue
+            if node > self.node_count:
+                yield ipaddress.ip_network((acc << (bits - depth), depth)), self.record(node)
+            elif node < self.node_count:
+                if network.version == 6 and depth > network.prefixlen and node == self.ipv4_start:
+                    continue
+                stack.append((self.read(node, 1), depth + 1, (acc << 1) | 1))
+                stack.append((self.read(node, 0), depth + 1, acc << 1))
+
+    def close(self):
+
+        self.buf.close()
+        self.file.close()
+
+class Databases:
+
+    def __init__(self, path, mode):
+
+        self.path = path
+        self.mode = mode
+
+        self.city = maxminddb.open_database(os.path.join(path, 'GeoLite2-City.mmdb'), mode = MODES[mode])
+        self.asn = maxminddb.open_database(os.path.join(path, 'GeoLite2-ASN.mmdb'), mode = MODES[mode])
+
+        if os.path.exists(os.path.join(path, 'GeoLite2-Merged.mmdb')):
+            self.merged = maxminddb.open_database(os.path.join(path, 'GeoLite2-Merged.mmdb'), mode = MODES[mode])
+            self.tree = Tree(os.path.join(path, 'GeoLite2-Merged.mmdb'), self.merged)
+        else:
+            self.merged = None
+            self.tree = None
+
+        if ENGINE == 'direct' and os.path.exists(os.path.join(path, 'GeoLite2-IPv4.dir')):
+            self.direct = Direct(os.path.join(path, 'GeoLite2-IPv4.dir'))
+        else:
+            self.direct = None
+
+        if os.path.exists(os.path.join(path, 'GeoLite2-ASN.rev')):
+            self.reverse = Reverse(os.path.join(path, 'GeoLite2-ASN.rev'))
+        else:
+            self.reverse = None
+
+        with open(os.path.join(path, 'asn.updated'), 'r') as f:
+            self.asnupdated = f.read()
+
+        with open(os.path.join(path, 'city.updated'), 'r') as f:
+            self.cityupdated = f.read()
+
+        if os.path.exists(os.path.join(path, 'version')):
+            with open(os.path.join(path, 'version'), 'r') as f:
+                self.version = f.read()
+        else:
+            self.version = None
+
+    def close(self):
+
+        self.city.close()
+        self.asn.close()
+
+        if self.merged is not None:
+            self.merged.close()
+            self.tree.close()
+
+        if self.direct is not None:
+            self.direct.close()
+
+        if self.reverse is not None:
+            self.reverse.close()
+
+def openmode():
+
+    mode = os.environ.get('GEOLITE_MODE', 'auto')
+
+    # The C extension is preferred whenever it is installed; the function
+    # memory size only chooses between the pure Python modes.
+
+    if mode == 'auto':
+        if importlib.util.find_spec('maxminddb.extension') is not None:
+            mode = 'ext'
+        else:
+            memory = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '128'))
+            mode = 'memory' if memory >= 512 else 'mmap'
+
+    return mode
+
+databases = None
+
+def load():
+
+    global databases
+
+    if databases is None:
+        databases = Databases(os.environ.get('GEOLITE_PATH', ''), openmode())
+
+    return databases
+
+class NetworkCache:
+
+    def __init__(self, size):
+
+        self.size = size
+        self.version = None
+        self.entries = collections.OrderedDict()
+        self.counts = {4: {}, 6: {}}
+        self.prefixes = {4: (), 6: ()}
+
+    def clear(self, version):
+
+        self.version = version
+        self.entries.clear()
+        self.counts = {4: {}, 6: {}}
+        self.prefixes = {4: (), 6: ()}
+
+    def get(self, version, ip):
+
+        if version != self.version:
+            self.clear(version)
+            return None
+
+        value = int(ip)
+        bits = ip.max_prefixlen
+
+        for prefixlen in self.prefixes[ip.version]:
+            key = (ip.version, prefixlen, value >> (bits - prefixlen))
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        return None
+
+    def put(self, version, network, value):
+
+        if version != self.version:
+            self.clear(version)
+
+        key = (network.version, network.prefixlen, int(network.network_address) >> (network.max_prefixlen - network.prefixlen))
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+
+        self.entries[key] = value
+        self.count(network.version, network.prefixlen, 1)
+
+        if len(self.entries) > self.size:
+            old, _ = self.entries.popitem(last = False)
+            self.count(old[0], old[1], -1)
+
+    def count(self, version, prefixlen, delta):
+
+        counts = self.counts[version]
+        counts[prefixlen] = counts.get(prefixlen, 0) + delta
+
+        if counts[prefixlen] == 0:
+            del counts[prefixlen]
+            self.prefixes[version] = tuple(sorted(counts, reverse = True))
+        elif counts[prefixlen] == delta:
+            self.prefixes[version] = tuple(sorted(counts, reverse = True))
+
+class FragmentCache:
+
+    def __init__(self, size):
+
+        self.size = size
+        self.version = None
+        self.entries = collections.OrderedDict()
+
+    def get(self, version, key, build):
+
+        if version != self.version:
+            self.version = version
+            self.entries.clear()
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        value = build()
+        self.entries[key] = value
+
+        if len(self.entries) > self.size:
+            self.entries.popitem(last = False)
+
+        return value
+
+def table(entries):
+
+    # Sorted start and end integers per IP version for a bisect search.
+
+    tables = {4: ([], [], []), 6: ([], [], [])}
+
+    for cidr, name, rfc in sorted(entries, key = lambda entry: ipaddress.ip_network(entry[0]).network_address.packed):
+        network = ipaddress.ip_network(cidr)
+        starts, ends, blocks = tables[network.version]
+        starts.append(int(network.network_address))
+        ends.append(int(network.broadcast_address))
+        blocks.append((network, {'name': name, 'rfc': rfc, 'net': str(network)}))
+
+    return tables
+
+SPECIAL = table(RESERVED)
+
+def special(ip):
+
+    starts, ends, blocks = SPECIAL[ip.version]
+    value = int(ip)
+    pos = bisect.bisect_right(starts, value) - 1
+
+    if pos >= 0 and value <= ends[pos]:
+        return blocks[pos]
+
+    return None
+
+citycache = NetworkCache(CACHE_SIZE)
+asncache = NetworkCache(CACHE_SIZE)
+fragments = FragmentCache(CACHE_SIZE)
+
+checked = 0
+reloading = None
+retired = []
+
+def reload():
+
+    global databases
+
+    import boto3
+
+    try:
+        s3 = boto3.client('s3')
+        manifest = json.loads(s3.get_object(Bucket = BUCKET, Key = 'manifest.json')['Body'].read())
+
+        if manifest['version'] == load().version:
+            return
+
+        print('Reloading', manifest['version'])
+
+        path = os.path.join('/tmp', manifest['version'])
+        os.makedirs(path, exist_ok = True)
+
+        for key in manifest['files']:
+            s3.download_file(BUCKET, manifest['prefix']+key, os.path.join(path, key+'.part'))
+            os.replace(os.path.join(path, key+'.part'), os.path.join(path, key))
+
+        current = Databases(path, openmode())
+        retired.append(databases)
+        databases = current
+
+    except Exception as e:
+        print('Reload failed:', e)
+
+def hotswap():
+
+    global checked, reloading
+
+    # Requests run one at a time per container, so handles retired by an
+    # earlier swap are no longer referenced by the time the next one starts.
+
+    while retired:
+        old = retired.pop()
+        old.close()
+        if old.path.startswith('/tmp/'):
+            shutil.rmtree(old.path, ignore_errors = True)
+
+    if RELOAD and BUCKET and time.time() - checked > RELOAD:
+        if reloading is None or not reloading.is_alive():
+            checked = time.time()
+            reloading = threading.Thread(target = reload, daemon = True)
+            reloading.start()
+
+def lookup(db, ip, selected = FIELDS):
+
+    block = special(ip)
+    if block is not None:
+        return citymap({}, None), block[0], asnmap({}, None), block[0]
+
+    if db.direct is not None and ip.version == 4:
+        return direct(db, ip)
+
+    ### A SINGLE SIDE ONLY WALKS THE DATABASE IT NEEDS ###
+
+    if db.merged is None or len(selected) == 1:
+        georecord, geonet = geo(db, ip) if 'geo' in selected else (None, None)
+        asnrecord, asnnet = org(db, ip) if 'asn' in selected else (None, None)
+        return georecord, geonet, asnrecord, asnnet
+
+    cachedgeo = citycache.get(db.cityupdated, ip)
+    cachedasn = asncache.get(db.asnupdated, ip)
+
+    if cachedgeo is None or cachedasn is None:
+        cachedgeo, cachedasn = merged(db, ip)
+        citycache.put(db.cityupdated, cachedgeo[1], cachedgeo)
+        asncache.put(db.asnupdated, cachedasn[1], cachedasn)
+
+    return cachedgeo[0], cachedgeo[1], cachedasn[0], cachedasn[1]
+
+def merged(db, ip):
+
+    record, prefixlen = db.merged.get_with_prefix_len(ip)
+    leaf = ipaddress.ip_network((ip, prefixlen), strict = False)
+
+    return split(record, ip, leaf)
+
+def split(record, ip, leaf):
+
+    if record is None:
+        record = {}
+
+    if 'city' in record:
+        cidr = ipaddress.ip_network((ip, leaf.prefixlen - record['city_delta']), strict = False)
+        georecord = citymap(record['city'], cidr)
+    else:
+        cidr = leaf
+        georecord = citymap({}, None)
+
+    if 'asn' in record:
+        net = ipaddress.ip_network((ip, leaf.prefixlen - record['asn_delta']), strict = False)
+        asnrecord = asnmap(record['asn'], net)
+    else:
+        net = leaf
+        asnrecord = asnmap({}, None)
+
+    return (georecord, cidr), (asnrecord, net)
+
+def direct(db, ip):
+
+    cachedgeo = citycache.get(db.cityupdated, ip)
+    cachedasn = asncache.get(db.asnupdated, ip)
+
+    if cachedgeo is not None and cachedasn is not None:
+        return cachedgeo[0], cachedgeo[1], cachedasn[0], cachedasn[1]
+
+    fields, cityprefix, asnfields, asnprefix = db.direct.get(ip) or (None, None, None, None)
+
+    if fields is not None:
+        cidr = ipaddress.ip_network((ip, cityprefix), strict = False)
+        georecord = dict(fields, cidr = str(cidr))
+        citycache.put(db.cityupdated, cidr, (georecord, cidr))
+    else:
+        cidr = None
+        georecord = citymap({}, None)
+
+    if asnfields is not None:
+        net = ipaddress.ip_network((ip, asnprefix), strict = False)
+        asnrecord = dict(asnfields, net = str(net))
+        asncache.put(db.asnupdated, net, (asnrecord, net))
+    else:
+        net = None
+        asnrecord = asnmap({}, None)
+
+    return georecord, cidr, asnrecord, net
+
+def citymap(record, cidr):
+
+    subdivision = (record.get('subdivisions') or [{}])[-1]
+
+    return {
+        'country':record.get('country', {}).get('names', {}).get('en'),
+        'c_iso':record.get('country', {}).get('iso_code'),
+        'state':subdivision.get('names', {}).get('en'),
+        's_iso':subdivision.get('iso_code'),
+        'city':record.get('city', {}).get('names', {}).get('en'),
+        'zip':record.get('postal', {}).get('code'),
+        'latitude':record.get('location', {}).get('latitude'),
+        'longitude':record.get('location', {}).get('longitude'),
+        'cidr':str(cidr)
+    }
+
+def asnmap(record, net):
+
+    return {
+        'id': record.get('autonomous_system_number'),
+        'org': record.get('autonomous_system_organization'),
+        'net': str(net)
+    }
+
+def geo(db, ip):
+
+    cached = citycache.get(db.cityupdated, ip)
+    if cached is not None:
+        return cached
+
+    cached = city(db, ip)
+    if cached[1] is not None:
+        citycache.put(db.cityupdated, cached[1], cached)
+
+    return cached
+
+def org(db, ip):
+
+    cached = asncache.get(db.asnupdated, ip)
+    if cached is not None:
+        return cached
+
+    cached = autonomous(db, ip)
+    if cached[1] is not None:
+        asncache.put(db.asnupdated, cached[1], cached)
+
+    return cached
+
+def city(db, ip):
 
     try:
-        ip = ipaddress.ip_address(event['rawQueryString'])
-        ip = str(event['rawQueryString'])
+        record, prefixlen = db.city.get_with_prefix_len(ip)
     except ValueError:
-        ip = ipaddress.ip_address(event['requestContext']['http']['sourceIp'])
-        ip = str(event['requestContext']['http']['sourceIp'])
+        return citymap({}, None), None
+
+    cidr = ipaddress.ip_network((ip, prefixlen), strict = False)
+
+    if record is None:
+        return citymap({}, None), cidr
+
+    return citymap(record, cidr), cidr
+
+def autonomous(db, ip):
 
     try:
-        with geoip2.database.Reader('GeoLite2-City.mmdb') as reader:
-            response = reader.city(ip)
-            country_code = response.country.iso_code
-            country_name = response.country.name
-            state_code = response.subdivisions.most_specific.iso_code
-            state_name = response.subdivisions.most_specific.name
-            city_name = response.city.name
-            zip_code = response.postal.code
-            latitude = response.location.latitude
-            longitude = response.location.longitude
-            cidr = response.traits.network
-    except:
-        country_code = None
-        country_name = None
-        state_code = None
-        state_name = None
-        city_name = None
-        zip_code = None
-        latitude = None
-        longitude = None
-        cidr = None
+        record, prefixlen = db.asn.get_with_prefix_len(ip)
+    except ValueError:
+        return asnmap({}, None), None
+
+    net = ipaddress.ip_network((ip, prefixlen), strict = False)
+
+    if record is None:
+        return asnmap({}, None), net
+
+    return asnmap(record, net), net
+
+def addresses(event):
+
+    body = event.get('body') or ''
+
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode()
+
+    body = body.strip()
+
+    if body.startswith('['):
+        items = json.loads(body)
+    else:
+        items = body.splitlines()
+
+    return [str(item).strip() for item in items if str(item).strip() != '']
+
+def resolve(db, items, selected = FIELDS):
+
+    parsed = {}
+    for item in items:
+        if item not in parsed:
+            try:
+                parsed[item] = ipaddress.ip_address(item)
+            except ValueError:
+                parsed[item] = None
+
+    ### SORTED UNIQUE ADDRESSES SHARE THE PREVIOUS NETWORK LOOKUP ###
+
+    unique = sorted(set(ip for ip in parsed.values() if ip is not None), key = lambda ip: (ip.version, int(ip)))
+
+    found = {}
+    geonet = None
+    asnnet = None
+
+    for ip in unique:
+        if special(ip) is not None or ('geo' in selected and (geonet is None or ip not in geonet)) or ('asn' in selected and (asnnet is None or ip not in asnnet)):
+            georecord, geonet, asnrecord, asnnet = lookup(db, ip, selected)
+        found[ip] = (georecord, geonet, asnrecord, asnnet)
+
+    return [(item, parsed[item], found.get(parsed[item])) for item in items]
+
+def batch(db, items, selected = FIELDS):
+
+    results = []
+    for item, ip, found in resolve(db, items, selected):
+        if ip is None:
+            results.append({
+                'ip': item,
+                'error': 'invalid ip address'
+            })
+        else:
+            results.append(result(selected, ip, found))
+
+    return results
+
+def result(selected, ip, found):
+
+    msg = {'ip': str(ip)}
+
+    block = special(ip)
+    if block is not None:
+        msg['reserved'] = block[1]
+
+    msg.update(project(selected, found[0], found[2]))
+
+    return msg
+
+def projection(params):
+
+    # fields=asn.id,asn.org or fields=c_iso selects sub keys, fields=asn a
+    # whole side; sides that are not selected are never looked up.
+
+    chosen = {}
+
+    for name in params.get('fields', '').split(','):
+        name = name.strip()
+        if name == '':
+            continue
+        if name in FIELDS:
+            chosen.setdefault(name, set()).update(FIELDS[name])
+            continue
+        side, _, key = name.rpartition('.')
+        sides = [side] if side != '' else [side for side in FIELDS if key in FIELDS[side]]
+        if len(sides) != 1 or sides[0] not in FIELDS or key not in FIELDS[sides[0]]:
+            raise ValueError('Unknown field '+name)
+        chosen.setdefault(sides[0], set()).add(key)
+
+    if len(chosen) == 0:
+        return FIELDS
+
+    return {side: tuple(key for key in FIELDS[side] if key in chosen[side]) for side in FIELDS if side in chosen}
+
+def project(selected, georecord, asnrecord):
+
+    if selected is FIELDS:
+        return {'geo': georecord, 'asn': asnrecord}
+
+    projected = {}
+
+    if 'geo' in selected:
+        projected['geo'] = {key: georecord[key] for key in selected['geo']}
+    if 'asn' in selected:
+        projected['asn'] = {key: asnrecord[key] for key in selected['asn']}
+
+    return projected
+
+def members(style, value):
+
+    return json.dumps(value, **STYLES[style])[1:-1].strip('\n')
+
+def document(style, parts):
+
+    if style == 'pretty':
+        return '{\n' + ',\n'.join(parts) + '\n}'
+
+    return '{' + STYLES[style]['separators'][0].join(parts) + '}'
+
+def fragment(db, style, selected, georecord, geonet, asnrecord, asnnet):
+
+    # The geo and asn members are identical for every address that resolves
+    # to the same City and ASN network pair, so they are encoded only once.
+
+    return fragments.get(
+        (db.cityupdated, db.asnupdated),
+        (style, tuple(selected.items()), geonet, asnnet),
+        lambda: members(style, project(selected, georecord, asnrecord))
+    )
+
+def summary(db, desc):
+
+    return {
+        'attribution':desc,
+        'geolite2-asn.mmdb':db.asnupdated,
+        'geolite2-city.mmdb':db.cityupdated,
+        'region': os.environ['AWS_REGION']
+    }
+
+def footer(db, style, desc):
+
+    return fragments.get(
+        (db.cityupdated, db.asnupdated),
+        (style, 'footer'),
+        lambda: members(style, summary(db, desc))
+    )
+
+def parts(db, style, selected, ip, found):
+
+    encoded = [members(style, {'ip': str(ip)})]
+
+    block = special(ip)
+    if block is not None:
+        encoded.append(fragments.get(
+            (db.cityupdated, db.asnupdated),
+            (style, 'reserved', block[0]),
+            lambda: members(style, {'reserved': block[1]})
+        ))
+
+    encoded.append(fragment(db, style, selected, *found))
+
+    return encoded
+
+def render(db, style, selected, ip, found):
+
+    return document(style, parts(db, style, selected, ip, found))
+
+def query(event):
+
+    # A leading segment without = is the address, as in ?8.8.8.8; key= keeps
+    # its blank value so it reaches the handler that owns the key.
+
+    params = {}
+
+    for part in (event.get('rawQueryString') or '').split('&'):
+        if part == '':
+            continue
+        if '=' not in part and 'ip' not in params:
+            params['ip'] = urllib.parse.unquote_plus(part)
+            continue
+        for key, value in urllib.parse.parse_qsl(part, keep_blank_values = True):
+            params[key] = value
+
+    return params
+
+def output(event, params, default):
+
+    accept = (event.get('headers') or {}).get('accept', '').replace(' ', '').lower()
+
+    for media in accept.split(','):
+        kind = MEDIA.get(media.split(';')[0])
+        if kind in CODECS:
+            return kind
+
+    if params.get('format') == 'compact' or 'format=compact' in accept:
+        return 'compact'
+
+    return default
+
+def binary(style, msg):
+
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': CONTENT[style]
+        },
+        'body': base64.b64encode(CODECS[style](msg)).decode(),
+        'isBase64Encoded': True
+    }
+
+def subnets(event, db, params, selected, desc):
+
+    if db.tree is None:
+        return {
+            'statusCode': 404,
+            'body': json.dumps('CIDR queries need GeoLite2-Merged.mmdb.')
+        }
 
     try:
-        with geoip2.database.Reader('GeoLite2-ASN.mmdb') as reader2:
-            response2 = reader2.asn(ip)
-            asn = response2.autonomous_system_number
-            org = response2.autonomous_system_organization
-            net = response2.network
-    except:
-        asn = None
-        org = None
-        net = None
+        network = ipaddress.ip_network(params.get('cidr') or params.get('ip', ''), strict = False)
+        start = ipaddress.ip_address(params.get('start', str(network.network_address)))
+        limit = max(min(int(params.get('limit', '256')), 4096), 1)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'body': json.dumps('CIDR must look like 134.129.0.0/16, start must be an address of the same version and limit a number.')
+        }
 
-    f = open('asn.updated', 'r')
-    asnupdated = f.read()
-    f.close()
+    if start.version != network.version:
+        return {
+            'statusCode': 400,
+            'body': json.dumps('CIDR must look like 134.129.0.0/16, start must be an address of the same version and limit a number.')
+        }
 
-    f = open('city.updated', 'r')
-    cityupdated = f.read()
-    f.close()
+    style = output(event, params, 'pretty')
 
-    desc = 'This product includes GeoLite2 data created by MaxMind, available from https://www.maxmind.com.'
+    ### ONE SUBTREE WALK, RESUMED FROM START FOR EACH PAGE ###
+
+    # Leaves are fragments of the merged tree, so adjacent leaves answered by
+    # the same City and ASN networks are reported as one first to last range.
+
+    address = type(network.network_address)
+    lower = max(int(start), int(network.network_address))
+    upper = int(network.broadcast_address)
+    runs = []
+    resume = None
+
+    for leaf, record in db.tree.walk(network, int(start)):
+
+        georecord, asnrecord = split(record, leaf.network_address, leaf)
+        key = (georecord[1] if 'city' in record else None, asnrecord[1] if 'asn' in record else None)
+        first = max(int(leaf.network_address), lower)
+        last = min(int(leaf.broadcast_address), upper)
+
+        if runs and runs[-1][0] == key and runs[-1][2] + 1 == first:
+            runs[-1][2] = last
+            continue
+
+        if len(runs) == limit:
+            resume = str(leaf.network_address)
+            break
+
+        runs.append([key, first, last, georecord[0], asnrecord[0]])
+
+    pieces = []
+
+    for key, first, last, georecord, asnrecord in runs:
+        piece = {'first': str(address(first)), 'last': str(address(last))}
+        piece.update(project(selected, georecord, asnrecord))
+        pieces.append(piece)
 
-    code = 200
     msg = {
-        'ip':str(ip),
-        'geo': {
-            'country':country_name,
-            'c_iso':country_code,
-            'state':state_name,
-            's_iso':state_code,
-            'city':city_name,
-            'zip':zip_code,
-            'latitude':latitude,
-            'longitude':longitude,
-            'cidr':str(cidr)
-        },
-        'asn': {
-            'id': asn,
+        'cidr': str(network),
+        'networks': pieces,
+        'next': resume
+    }
+    msg.update(summary(db, desc))
+
+    if style in CODECS:
+        return binary(style, msg)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(msg, **STYLES[style])
+    }
+
+def holdings(event, db, params, desc):
+
+    if db.reverse is None:
+        return {
+            'statusCode': 404,
+            'body': json.dumps('ASN reverse index is not available.')
+        }
+
+    style = output(event, params, 'pretty')
+
+    if 'asn' in params:
+
+        try:
+            number = int(params['asn'].upper().removeprefix('AS'))
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'body': json.dumps('ASN must be a number like 19530 or AS19530.')
+            }
+
+        networks = db.reverse.networks(number)
+        org = None
+        if networks:
+            org = asnmap(db.asn.get(networks[0].network_address) or {}, None)['org']
+
+        msg = {
+            'asn': number,
             'org': org,
-            'net': str(net)
-        },
-        'attribution':desc,
-        'geolite2-asn.mmdb':asnupdated,
-        'geolite2-city.mmdb':cityupdated,
-        'region': os.environ['AWS_REGION']
+            'networks': [str(network) for network in networks]
+        }
+
+    else:
+
+        if params['org'].strip() == '':
+            return {
+                'statusCode': 400,
+                'body': json.dumps('Organization must be the start of a name like org=google.')
+            }
+
+        try:
+            limit = max(min(int(params.get('limit', '100')), 1000), 1)
+        except ValueError:
+            limit = 100
+
+        msg = {
+            'org': params['org'],
+            'matches': db.reverse.orgs(params['org'], limit)
+        }
+
+    msg.update(summary(db, desc))
+
+    if style in CODECS:
+        return binary(style, msg)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(msg, **STYLES[style])
     }
 
+def handler(event, context):
+
+    # Retired handles are closed before this request takes its own, so a
+    # swap finishing in between can only retire the next request's handle.
+
+    hotswap()
+
+    db = load()
+
+    desc = 'This product includes GeoLite2 data created by MaxMind, available from https://www.maxmind.com.'
+
+    params = query(event)
+
+    try:
+        selected = projection(params)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': json.dumps(str(e)+', fields are '+', '.join(side+'.'+key for side in FIELDS for key in FIELDS[side])+'.')
+        }
+
+    if event['requestContext']['http']['method'] == 'POST':
+
+        try:
+            items = addresses(event)
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'body': json.dumps('Body must be a JSON array or newline delimited list of ip addresses.')
+            }
+
+        if len(items) > BATCH_LIMIT:
+            return {
+                'statusCode': 413,
+                'body': json.dumps('Batch is limited to '+str(BATCH_LIMIT)+' ip addresses.')
+            }
+
+        style = output(event, params, 'plain')
+
+        if style in CODECS:
+            msg = {'results': batch(db, items, selected)}
+            msg.update(summary(db, desc))
+            return binary(style, msg)
+
+        separators = STYLES[style]['separators']
+
+        results = []
+        for item, ip, found in resolve(db, items, selected):
+            if ip is None:
+                results.append(json.dumps({'ip': item, 'error': 'invalid ip address'}, **STYLES[style]))
+            else:
+                results.append(render(db, style, selected, ip, found))
+
+        return {
+            'statusCode': 200,
+            'body': document(style, [
+                json.dumps('results') + separators[1] + '[' + separators[0].join(results) + ']',
+                footer(db, style, desc)
+            ])
+        }
+
+    if 'cidr' in params or '/' in params.get('ip', ''):
+        return subnets(event, db, params, selected, desc)
+
+    if 'asn' in params or 'org' in params:
+        return holdings(event, db, params, desc)
+
+    try:
+        ip = ipaddress.ip_address(params.get('ip', ''))
+    except ValueError:
+        ip = ipaddress.ip_address(event['requestContext']['http']['sourceIp'])
+
+    style = output(event, params, 'pretty')
+
+    found = lookup(db, ip, selected)
+
+    if style in CODECS:
+        msg = result(selected, ip, found)
+        msg.update(summary(db, desc))
+        return binary(style, msg)
+
+    code = 200
+
     return {
         'statusCode': code,
-        'body': json.dumps(msg, indent = 4)
-    }
\ No newline at end of file
+        'body': document(style, parts(db, style, selected, ip, found) + [footer(db, style, desc)])
+    }
@@ -0,0 +1,302 @@
+import boto3
+import delta
+import direct
+import download
+import json
+import mmdb
+import multiprocessing
+import os
+import ranges
+import reverse
+import spatial
+import time
+import zipfile
+
+# Derived builds and packaging for a GeoLite2 release. The download function
+# invokes handler() asynchronously once the raw databases are staged, and
+# handler() invokes merge() the same way once the trimmed City is staged, so
+# the merged and direct builds and the packaging get a timeout of their own.
+# Independent builds in a stage run in separate processes; Lambda has no
+# /dev/shm for a Pool, so each result comes back over a pipe.
+
+# Built by handler() and read by merge() from the staged bucket.
+
+INTERMEDIATE = [
+    'GeoLite2-ASN.rev',
+    'GeoLite2-City-Slim.mmdb'
+]
+
+CODE_LIMIT = 262144000
+TMP_LIMIT = 1073741824
+
+CONTEXT = multiprocessing.get_context('fork')
+
+def run(target, args, conn):
+
+    start = time.perf_counter()
+
+    try:
+        conn.send((True, target(*args), time.perf_counter() - start))
+    except Exception as e:
+        conn.send((False, repr(e), time.perf_counter() - start))
+
+    conn.close()
+
+def processes(name, tasks):
+
+    start = time.perf_counter()
+    running = {}
+
+    for label, (target, args) in tasks.items():
+        parent, child = CONTEXT.Pipe(duplex = False)
+        process = CONTEXT.Process(target = run, args = (target, args, child))
+        process.start()
+        child.close()
+        running[label] = (process, parent)
+
+    results = {}
+    failed = []
+
+    for label, (process, parent) in running.items():
+        try:
+            ok, result, seconds = parent.recv()
+        except EOFError:
+            ok, result, seconds = False, 'exit code '+str(process.exitcode), 0
+        process.join()
+        print(label+':', str(round(seconds, 3))+'s')
+        if ok:
+            results[label] = result
+        else:
+            failed.append(label+': '+result)
+
+    print(name+' stage:', str(round(time.perf_counter() - start, 3))+'s')
+
+    if failed:
+        raise RuntimeError(', '.join(failed))
+
+    return results
+
+def handler(event, context):
+
+    s3_client = boto3.client('s3')
+
+    prefix = event['prefix']
+    refreshed = event['refreshed']
+
+    tasks = {}
+    for key in download.DATA + download.CODE:
+        tasks['Copying '+key] = download.copy(s3_client, os.environ['S3_STAGED'], key)
+    for name, release in refreshed.items():
+        if release['previous']:
+            tasks['Previous GeoLite2-'+name+'.mmdb'] = download.previous(s3_client, 'previous/GeoLite2-'+name+'.mmdb', '/tmp/GeoLite2-'+name+'.previous.mmdb')
+
+    copied = download.stage('Copy', tasks)
+
+    ### RELEASE INDEXES AND THE TRIMMED CITY BUILD ###
+
+    tasks = {
+        'Trimming GeoLite2-City-Slim.mmdb': (mmdb.rewrite, ('/tmp/GeoLite2-City.mmdb', '/tmp/GeoLite2-City-Slim.mmdb', mmdb.slim)),
+        'Indexing GeoLite2-ASN.rev': (reverse.build, ('/tmp/GeoLite2-ASN.mmdb', '/tmp/GeoLite2-ASN.rev'))
+    }
+
+    keys = []
+
+    for name, release in refreshed.items():
+
+        tasks['Indexing GeoLite2-'+name+'.npz'] = (ranges.build, ('/tmp/GeoLite2-'+name+'.mmdb', '/tmp/GeoLite2-'+name+'.npz'))
+        keys.append('GeoLite2-'+name+'.npz')
+
+        if name == 'City':
+            tasks['Indexing GeoLite2-City.geo.npz'] = (spatial.build, ('/tmp/GeoLite2-City.mmdb', '/tmp/GeoLite2-City.geo.npz'))
+            keys.append('GeoLite2-City.geo.npz')
+
+        if copied.get('Previous GeoLite2-'+name+'.mmdb'):
+            tasks['Diffing GeoLite2-'+name+'.delta.jsonl.gz'] = (delta.build, (
+                '/tmp/GeoLite2-'+name+'.previous.mmdb',
+                '/tmp/GeoLite2-'+name+'.mmdb',
+                '/tmp/GeoLite2-'+name+'.delta.jsonl.gz',
+                'GeoLite2-'+name,
+                release['from'],
+                release['to']
+            ))
+
+    built = processes('Build', tasks)
+
+    for name in refreshed:
+        label = 'Diffing GeoLite2-'+name+'.delta.jsonl.gz'
+        if label in built:
+            print(name+' changed ranges:', built[label])
+
+    tasks = {}
+    for key in keys:
+        tasks['Staged '+key] = download.upload(s3_client, '/tmp/'+key, os.environ['S3_STAGED'], key)
+        tasks['Research '+key] = download.upload(s3_client, '/tmp/'+key, os.environ['S3_RESEARCH'], prefix+key)
+    for name in refreshed:
+        key = 'GeoLite2-'+name+'.delta.jsonl.gz'
+        if 'Diffing '+key in built:
+            tasks['Research '+key] = download.upload(s3_client, '/tmp/'+key, os.environ['S3_RESEARCH'], prefix+key)
+
+    for key in INTERMEDIATE:
+        tasks['Staged '+key] = download.upload(s3_client, '/tmp/'+key, os.environ['S3_STAGED'], key)
+
+    download.stage('Upload', tasks)
+
+    lambda_client = boto3.client('lambda')
+
+    lambda_client.invoke(
+        FunctionName = os.environ['MERGE_FUNCTION'],
+        InvocationType = 'Event',
+        Payload = json.dumps({
+            'version': event['version'],
+            'code': event['code']
+        }).encode()
+    )
+
+    print("Merging "+event['version'])
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps('This product includes GeoLite2 data created by MaxMind, available from https://www.maxmind.com.')
+    }
+
+def merge(event, context):
+
+    ssm = boto3.client('ssm')
+
+    s3_client = boto3.client('s3')
+
+    tasks = {}
+    for key in download.DATA + download.CODE + INTERMEDIATE:
+        if key != 'GeoLite2-City.mmdb':
+            tasks['Copying '+key] = download.copy(s3_client, os.environ['S3_STAGED'], key)
+
+    download.stage('Copy', tasks)
+
+    digest = event['version']
+    code = event['code']
+
+    with open('/tmp/version', 'w') as f:
+        f.write(digest)
+    f.close()
+
+    ### MERGED AND DIRECT BUILDS READ THE TRIMMED CITY ###
+
+    processes('Merge', {
+        'Merging GeoLite2-Merged.mmdb': (mmdb.merge, ('/tmp/GeoLite2-City-Slim.mmdb', '/tmp/GeoLite2-ASN.mmdb', '/tmp/GeoLite2-Merged.mmdb')),
+        'Indexing GeoLite2-IPv4.dir': (direct.build, ('/tmp/GeoLite2-City-Slim.mmdb', '/tmp/GeoLite2-ASN.mmdb', '/tmp/GeoLite2-IPv4.dir'))
+    })
+
+    ### SEARCH PACKAGE SIZE AGAINST THE LAMBDA LIMITS ###
+
+    # The IPv4 table is an optional accelerator, search answers from the
+    # mmdb files without it, so it is the first file left out when the
+    # package would not fit the unzipped code limit or, with a second
+    # version on disk during a hot reload, the search /tmp.
+
+    package = dict(download.PACKAGE)
+
+    for key, path in package.items():
+        print(key+':', os.path.getsize(path), 'bytes')
+
+    size = sum(os.path.getsize(path) for path in package.values())
+
+    if size > CODE_LIMIT or 2 * size > TMP_LIMIT:
+        size -= os.path.getsize(package.pop('GeoLite2-IPv4.dir'))
+        print('Leaving out GeoLite2-IPv4.dir, search falls back to the mmdb files')
+
+    print('Package:', size, 'bytes of the', CODE_LIMIT, 'byte unzipped code limit')
+    print('Hot reload:', 2 * size, 'bytes of the', TMP_LIMIT, 'byte search /tmp with both versions on disk')
+
+    if size > CODE_LIMIT or 2 * size > TMP_LIMIT:
+        raise RuntimeError('Package of '+str(size)+' bytes does not fit the search function')
+
+    print("Packaging geoip2.zip")
+
+    with zipfile.ZipFile('/tmp/geoip2.zip', 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zipf:
+
+        for key, path in package.items():
+            zipf.write(path, key)
+
+        for key in download.CODE:
+            zipf.write('/tmp/'+key, key)
+
+        for root, dirs, files in os.walk('/tmp/geoip2'):
+            for file in files:
+                fullpath = os.path.join(root, file)
+                zipf.write(fullpath, fullpath[5:])
+
+        for root, dirs, files in os.walk('/tmp/maxminddb'):
+            for file in files:
+                fullpath = os.path.join(root, file)
+                zipf.write(fullpath, fullpath[5:])
+
+    zipf.close()
+
+    regions = json.loads(os.environ['SEARCH_REGIONS'])
+
+    previous = download.manifest(s3_client, os.environ['S3_STAGED'])
+
+    current = {
+        'version': digest,
+        'code': code,
+        'prefix': 'versions/'+digest+'/',
+        'files': list(package)
+    }
+
+    with open('/tmp/manifest.json', 'w') as f:
+        f.write(json.dumps(current))
+    f.close()
+
+    tasks = {
+        'Staged geoip2.zip': download.upload(s3_client, '/tmp/geoip2.zip', os.environ['S3_STAGED'], 'geoip2.zip')
+    }
+    for region in regions:
+        client = boto3.client('s3', region_name = region['region'])
+        tasks[region['region']+' geoip2.zip'] = download.upload(client, '/tmp/geoip2.zip', region['bucket'], 'geoip2.zip')
+        for key, path in package.items():
+            tasks[region['region']+' '+key] = download.upload(client, path, region['bucket'], current['prefix']+key)
+
+    download.stage('Replicate', tasks)
+
+    if os.environ.get('SEARCH_RELOAD') == 'true' and previous.get('code') == code:
+
+        print("Code unchanged, search functions will hot reload "+digest)
+
+    else:
+
+        tasks = {}
+        for region in regions:
+            client = boto3.client('lambda', region_name = region['region'])
+            tasks['Updating '+region['function']] = download.deploy(client, region['function'], region['bucket'])
+
+        download.stage('Deploy', tasks)
+
+    tasks = {
+        'Staged manifest.json': download.upload(s3_client, '/tmp/manifest.json', os.environ['S3_STAGED'], 'manifest.json')
+    }
+    for region in regions:
+        client = boto3.client('s3', region_name = region['region'])
+        tasks[region['region']+' manifest.json'] = download.upload(client, '/tmp/manifest.json', region['bucket'], 'manifest.json')
+
+    download.stage('Manifest', tasks)
+
+    ### VERSIONS THE MANIFEST NO LONGER REFERENCES ###
+
+    tasks = {}
+    for region in regions:
+        client = boto3.client('s3', region_name = region['region'])
+        tasks[region['region']+' retired'] = download.retire(client, region['bucket'], current['prefix'])
+
+    download.stage('Retire', tasks)
+
+    ssm.put_parameter(
+        Name = os.environ['SSM_PARAMETER_PACKAGE'],
+        Value = digest,
+        Type = 'String',
+        Overwrite = True
+    )
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps('This product includes GeoLite2 data created by MaxMind, available from https://www.maxmind.com.')
+    }
@@ -0,0 +1,70 @@
+import json
+import re
+
+# Snapshot catalog of the research bucket, kept at catalog.json:
+#   {"City": [entry, ...], "ASN": [entry, ...]}
+# with one entry per dated GeoLite2 snapshot, oldest first:
+#   time     UTC hour of the YYYY/MM/DD/HH/ prefix, ISO 8601
+#   prefix   research key prefix holding the snapshot
+#   size     bytes of the .mmdb object
+#   updated  MaxMind Last-Modified of the release, when recorded
+# A snapshot answers for every instant from its hour until the next one.
+
+KEY = re.compile(r'^(\d{4})/(\d{2})/(\d{2})/(\d{2})/GeoLite2-(City|ASN)\.mmdb$')
+
+def load(s3_client, bucket):
+
+    try:
+        response = s3_client.get_object(Bucket = bucket, Key = 'catalog.json')
+        return json.loads(response['Body'].read())
+    except s3_client.exceptions.ClientError:
+        return {}
+
+def updated(s3_client, bucket, prefix, name):
+
+    try:
+        response = s3_client.get_object(Bucket = bucket, Key = prefix+name.lower()+'.updated')
+        return response['Body'].read().decode().strip()
+    except s3_client.exceptions.ClientError:
+        return None
+
+def build(s3_client, bucket):
+
+    # Lists the bucket and adds any snapshot the catalog does not hold yet,
+    # so a missing or stale catalog heals on the next run.
+
+    catalog = load(s3_client, bucket)
+    known = {(name, entry['prefix']) for name, entries in catalog.items() for entry in entries}
+    added = 0
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    for page in paginator.paginate(Bucket = bucket):
+        for item in page.get('Contents', []):
+            match = KEY.match(item['Key'])
+            if match is None:
+                continue
+            year, month, day, hour, name = match.groups()
+            prefix = year+'/'+month+'/'+day+'/'+hour+'/'
+            if (name, prefix) in known:
+                continue
+            catalog.setdefault(name, []).append({
+                'time': year+'-'+month+'-'+day+'T'+hour+':00:00Z',
+                'prefix': prefix,
+                'size': item['Size'],
+                'updated': updated(s3_client, bucket, prefix, name)
+            })
+            known.add((name, prefix))
+            added += 1
+
+    if added > 0:
+        for entries in catalog.values():
+            entries.sort(key = lambda entry: entry['time'])
+        s3_client.put_object(
+            Bucket = bucket,
+            Key = 'catalog.json',
+            Body = json.dumps(catalog).encode(),
+            ContentType = 'application/json'
+        )
+
+    return added
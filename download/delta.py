@@ -0,0 +1,89 @@
+import gzip
+import json
+
+import mmdb
+import ranges
+
+# Delta feed between two builds of the same GeoLite2 database, as gzipped
+# JSON lines. The first line names the database and both versions, and each
+# following line is one address range whose enrichment changed:
+#   added    the new database covers addresses the old one did not
+#   removed  the old database covered addresses the new one does not
+#   changed  the projected record is different
+#   resized  the record is the same but its network is not
+# Adjacent ranges with the same change and records are merged, and each line
+# lists the CIDRs that exactly cover its range.
+
+def fields(database, cache, value):
+
+    if value is None:
+        return None
+
+    if value[1] not in cache:
+        cache[value[1]] = ranges.fields(database.record(value[1]))
+
+    return cache[value[1]]
+
+def changes(old, new):
+
+    oldcache = {}
+    newcache = {}
+
+    for start, end, before, after in mmdb.overlay(old.ranges(), new.ranges()):
+
+        previous = fields(old, oldcache, before)
+        current = fields(new, newcache, after)
+
+        if previous is None:
+            change = 'added'
+        elif current is None:
+            change = 'removed'
+        elif previous != current:
+            change = 'changed'
+        elif before[0] != after[0]:
+            change = 'resized'
+        else:
+            continue
+
+        yield start, end, change, previous, current
+
+def build(oldpath, newpath, path, database, since, until):
+
+    old = mmdb.Database(oldpath)
+    new = mmdb.Database(newpath)
+
+    count = 0
+    pending = None
+
+    with gzip.open(path, 'wt', compresslevel = 9) as f:
+
+        f.write(json.dumps({'database': database, 'from': since, 'to': until})+'\n')
+
+        for start, end, change, previous, current in changes(old, new):
+            if pending is not None and pending[1] + 1 == start and tuple(pending[2:]) == (change, previous, current):
+                pending[1] = end
+                continue
+            if pending is not None:
+                write(f, pending)
+                count += 1
+            pending = [start, end, change, previous, current]
+
+        if pending is not None:
+            write(f, pending)
+            count += 1
+
+    old.close()
+    new.close()
+
+    return count
+
+def write(f, pending):
+
+    start, end, change, previous, current = pending
+
+    f.write(json.dumps({
+        'change': change,
+        'networks': [str(mmdb.network(base, prefixlen)) for base, prefixlen in mmdb.cidrs(start, end)],
+        'old': previous,
+        'new': current
+    })+'\n')
@@ -0,0 +1,130 @@
+import json
+import numpy
+import struct
+
+import mmdb
+import ranges
+
+# DIR-24-8 layout (little-endian uint32 unless noted):
+#   header   magic, group, pattern, palette, entry and record counts
+#   tbl24    2^24 entries indexed by the first 24 bits of the address
+#   groups   pattern id and palette position pairs, one per /24 block split
+#            by longer prefixes
+#   patterns 256 uint8 slots per distinct split of a /24 block
+#   palette  the entries a group's slots select, in slot order
+#   records  entry count pairs of City and ASN record ids plus one, 0 when
+#            the side has no data
+#   prefixes entry count pairs of uint8 City and ASN prefix lengths, padded
+#            to 4 bytes
+#   offsets  record count + 1 positions into the JSON record blob
+#   blob     one JSON document per distinct projected City or ASN record
+# A table entry of 0 is empty, the high bit selects a group, otherwise it is
+# the entry id plus one. Entries pair the records with the prefix lengths of
+# their networks, so the blob grows with distinct records rather than with
+# networks. A split block costs 8 bytes plus its few palette entries, since
+# blocks split at the same boundaries share one pattern of slots.
+
+MAGIC = b'DIR248\x00\x03'
+
+def store(payloads, records, database, value):
+
+    if value is None:
+        return 0
+
+    payload = json.dumps(ranges.fields(database.record(value[1]))).encode()
+    if payload not in payloads:
+        records.append(payload)
+        payloads[payload] = len(records)
+
+    return payloads[payload]
+
+def build(citypath, asnpath, path):
+
+    city = mmdb.Database(citypath)
+    asn = mmdb.Database(asnpath)
+
+    tbl24 = numpy.zeros(2 ** 24, dtype = numpy.uint32)
+    groups = {}
+    tbl8 = []
+    ids = {}
+    entries = {}
+    payloads = {}
+    records = []
+
+    for start, end, geo, org in mmdb.overlay(city.ranges(), asn.ranges()):
+
+        if start >= 2 ** 32:
+            break
+        end = min(end, 2 ** 32 - 1)
+
+        key = (geo, org)
+        if key not in ids:
+            pair = (
+                store(payloads, records, city, geo),
+                store(payloads, records, asn, org),
+                geo[0] - 96 if geo is not None else 0,
+                org[0] - 96 if org is not None else 0
+            )
+            if pair not in entries:
+                entries[pair] = len(entries) + 1
+            ids[key] = entries[pair]
+
+        entry = ids[key]
+        first = (start + 255) >> 8
+        last = (end + 1) >> 8
+
+        if first < last:
+            tbl24[first:last] = entry
+
+        partial = []
+        if start & 0xff:
+            partial.append((start, min(end, (first << 8) - 1)))
+        if (end + 1) & 0xff:
+            partial.append((max(start, last << 8), end))
+
+        for low, high in partial:
+            block = low >> 8
+            if block not in groups:
+                groups[block] = len(tbl8)
+                tbl8.append(numpy.full(256, tbl24[block], dtype = numpy.uint32))
+                tbl24[block] = 0x80000000 | groups[block]
+            tbl8[groups[block]][low & 0xff:(high & 0xff) + 1] = entry
+
+    city.close()
+    asn.close()
+
+    ### SPLIT BLOCKS BECOME A SHARED SLOT PATTERN AND A SHORT PALETTE ###
+
+    patterns = {}
+    layout = numpy.zeros((len(tbl8), 2), dtype = numpy.uint32)
+    palette = []
+
+    for index, group in enumerate(tbl8):
+        values, first, inverse = numpy.unique(group, return_index = True, return_inverse = True)
+        order = numpy.argsort(first)
+        rank = numpy.empty(len(order), dtype = numpy.uint8)
+        rank[order] = numpy.arange(len(order))
+        layout[index] = (patterns.setdefault(rank[inverse].tobytes(), len(patterns)), len(palette))
+        palette.extend(values[order].tolist())
+
+    pairs = sorted(entries, key = entries.get)
+    prefixes = bytearray()
+    for _, _, cityprefix, asnprefix in pairs:
+        prefixes += bytes([cityprefix, asnprefix])
+    prefixes += b'\x00' * (-len(prefixes) % 4)
+
+    offsets = numpy.zeros(len(records) + 1, dtype = numpy.uint32)
+    offsets[1:] = numpy.cumsum([len(record) for record in records])
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<IIIII', len(tbl8), len(patterns), len(palette), len(pairs), len(records)))
+        f.write(tbl24.astype('<u4').tobytes())
+        f.write(layout.astype('<u4').tobytes())
+        for pattern in patterns:
+            f.write(pattern)
+        f.write(numpy.array(palette, dtype = '<u4').tobytes())
+        f.write(numpy.array([[georecord, asnrecord] for georecord, asnrecord, _, _ in pairs], dtype = '<u4').reshape(-1).tobytes())
+        f.write(bytes(prefixes))
+        f.write(offsets.astype('<u4').tobytes())
+        for record in records:
+            f.write(record)
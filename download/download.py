@@ -1,195 +1,293 @@
 import boto3
+import catalog
+import concurrent.futures
 import datetime
+import hashlib
 import json
 import os
 import requests
 import tarfile
-import zipfile
+import time
+
+CODE = [
+    'search.py'
+]
+
+DATA = [
+    'asn.updated',
+    'city.updated',
+    'GeoLite2-ASN.mmdb',
+    'GeoLite2-City.mmdb'
+]
+
+PACKAGE = {
+    'asn.updated': '/tmp/asn.updated',
+    'city.updated': '/tmp/city.updated',
+    'version': '/tmp/version',
+    'GeoLite2-ASN.mmdb': '/tmp/GeoLite2-ASN.mmdb',
+    'GeoLite2-City.mmdb': '/tmp/GeoLite2-City-Slim.mmdb',
+    'GeoLite2-Merged.mmdb': '/tmp/GeoLite2-Merged.mmdb',
+    'GeoLite2-IPv4.dir': '/tmp/GeoLite2-IPv4.dir',
+    'GeoLite2-ASN.rev': '/tmp/GeoLite2-ASN.rev'
+}
+
+CHUNK = 1048576
+
+def extract(url, login, path):
+
+    digest = hashlib.sha256()
+
+    with requests.get(url, auth=(login['api'], login['key']), stream = True) as response:
+        response.raise_for_status()
+        with tarfile.open(fileobj = response.raw, mode = 'r|gz') as tar:
+            with open(path, 'wb') as w:
+                for member in tar:
+                    if os.path.splitext(member.name)[1] == '.mmdb':
+                        r = tar.extractfile(member)
+                        if r is not None:
+                            for chunk in iter(lambda: r.read(CHUNK), b''):
+                                digest.update(chunk)
+                                w.write(chunk)
+                            r.close()
 
-def handler(event, context):
+    return digest.hexdigest()
 
-    secret = boto3.client('secretsmanager')
+def timed(label, task):
 
-    getsecret = secret.get_secret_value(
-        SecretId = os.environ['SECRET_MGR_ARN']
-    )
+    start = time.perf_counter()
+    result = task()
+    print(label+':', str(round(time.perf_counter() - start, 3))+'s')
 
-    login = json.loads(getsecret['SecretString'])
+    return result
 
-    ssm = boto3.client('ssm')
+def stage(name, tasks):
 
-    asn = ssm.get_parameter(
-        Name = os.environ['SSM_PARAMETER_ASN'], 
-        WithDecryption = False
-    )
+    start = time.perf_counter()
+    results = {}
 
-    city = ssm.get_parameter(
-        Name = os.environ['SSM_PARAMETER_CITY'], 
-        WithDecryption = False
-    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(len(tasks), 1)) as pool:
+        futures = {pool.submit(timed, label, task): label for label, task in tasks.items()}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
 
-    s3_client = boto3.client('s3')
+    print(name+' stage:', str(round(time.perf_counter() - start, 3))+'s')
 
-    year = datetime.datetime.now().strftime('%Y')
-    month = datetime.datetime.now().strftime('%m')
-    day = datetime.datetime.now().strftime('%d')
-    hour = datetime.datetime.now().strftime('%H')
+    return results
+
+def refresh(name, parameter, login, ssm, s3_client, prefix):
 
-    url = 'https://download.maxmind.com/geoip/databases/GeoLite2-City/download?suffix=tar.gz'
+    lower = name.lower()
+
+    url = 'https://download.maxmind.com/geoip/databases/GeoLite2-'+name+'/download?suffix=tar.gz'
     update = requests.head(url, auth=(login['api'], login['key']))
 
-    print('City:', update.headers['last-modified'])
-    with open('/tmp/city.updated', 'w') as f:
+    print(name+':', update.headers['last-modified'])
+    with open('/tmp/'+lower+'.updated', 'w') as f:
         f.write(update.headers['last-modified'])
     f.close()
 
-    if city['Parameter']['Value'] != update.headers['last-modified']:
+    current = ssm.get_parameter(
+        Name = parameter,
+        WithDecryption = False
+    )
 
-        print("Downloading GeoLite2-City.mmdb")
+    if current['Parameter']['Value'] == update.headers['last-modified']:
+        return False
 
-        url = 'https://download.maxmind.com/geoip/databases/GeoLite2-City/download?suffix=tar.gz'
-        response = requests.get(url, auth=(login['api'], login['key']))
-        with open('/tmp/maxmind.tar.gz', 'wb') as f:
-            f.write(response.content)
-        f.close()
+    print("Downloading GeoLite2-"+name+".mmdb")
 
-        with open('/tmp/GeoLite2-City.mmdb', 'wb') as w:
-            with tarfile.open('/tmp/maxmind.tar.gz', 'r:gz') as tar:
-                for member in tar.getmembers():
-                    if os.path.splitext(member.name)[1] == '.mmdb':
-                        r = tar.extractfile(member)
-                        if r is not None:
-                            content = r.read()
-                            r.close()
-                            w.write(content)
-            tar.close()
-        w.close()
-
-        response = s3_client.upload_file('/tmp/city.updated',os.environ['S3_STAGED'],'city.updated')
-        response = s3_client.upload_file('/tmp/GeoLite2-City.mmdb',os.environ['S3_STAGED'],'GeoLite2-City.mmdb')
-        response = s3_client.upload_file('/tmp/city.updated',os.environ['S3_RESEARCH'],year+'/'+month+'/'+day+'/'+hour+'/city.updated')
-        response = s3_client.upload_file('/tmp/GeoLite2-City.mmdb',os.environ['S3_RESEARCH'],year+'/'+month+'/'+day+'/'+hour+'/GeoLite2-City.mmdb')
-
-        ssm.put_parameter(
-            Name = os.environ['SSM_PARAMETER_CITY'],
-            Value = update.headers['last-modified'],
-            Type = 'String',
-            Overwrite = True
-        )
-
-    url = 'https://download.maxmind.com/geoip/databases/GeoLite2-ASN/download?suffix=tar.gz'
-    update = requests.head(url, auth=(login['api'], login['key']))
+    # The staged copy is kept server side as previous/ before it is replaced,
+    # so the build function can diff the release against it.
 
-    print('ASN:', update.headers['last-modified'])
-    with open('/tmp/asn.updated', 'w') as f:
-        f.write(update.headers['last-modified'])
-    f.close()
+    downloads = stage(name+' download', {
+        'Downloading GeoLite2-'+name+'.mmdb': lambda: extract(url, login, '/tmp/GeoLite2-'+name+'.mmdb'),
+        'Keeping GeoLite2-'+name+'.mmdb': keep(s3_client, 'GeoLite2-'+name+'.mmdb')
+    })
+
+    sha256 = downloads['Downloading GeoLite2-'+name+'.mmdb']
+
+    print(name+' SHA-256:', sha256)
+
+    tasks = {}
+    for key in [lower+'.updated', 'GeoLite2-'+name+'.mmdb']:
+        tasks['Staged '+key] = upload(s3_client, '/tmp/'+key, os.environ['S3_STAGED'], key)
+        tasks['Research '+key] = upload(s3_client, '/tmp/'+key, os.environ['S3_RESEARCH'], prefix+key)
+
+    stage(name+' upload', tasks)
+
+    ssm.put_parameter(
+        Name = parameter,
+        Value = update.headers['last-modified'],
+        Type = 'String',
+        Overwrite = True
+    )
+
+    return {
+        'from': current['Parameter']['Value'],
+        'to': update.headers['last-modified'],
+        'previous': downloads['Keeping GeoLite2-'+name+'.mmdb']
+    }
+
+def keep(s3_client, key):
 
-    if asn['Parameter']['Value'] != update.headers['last-modified']:
+    def task():
+        try:
+            s3_client.copy_object(
+                Bucket = os.environ['S3_STAGED'],
+                Key = 'previous/'+key,
+                CopySource = {'Bucket': os.environ['S3_STAGED'], 'Key': key}
+            )
+            return True
+        except s3_client.exceptions.ClientError:
+            return False
 
-        print("Downloading GeoLite2-ASN.mmdb")
+    return task
 
-        url = 'https://download.maxmind.com/geoip/databases/GeoLite2-ASN/download?suffix=tar.gz'
-        response = requests.get(url, auth=(login['api'], login['key']))
-        with open('/tmp/maxmind2.tar.gz', 'wb') as f:
-            f.write(response.content)
+def previous(s3_client, key, path):
+
+    def task():
+        try:
+            s3_client.download_file(os.environ['S3_STAGED'], key, path)
+            return True
+        except s3_client.exceptions.ClientError:
+            return False
+
+    return task
+
+def upload(s3_client, path, bucket, key):
+
+    return lambda: s3_client.upload_file(path, bucket, key)
+
+def copy(s3_client, bucket, key):
+
+    def task():
+        with open('/tmp/'+key, 'wb') as f:
+            s3_client.download_fileobj(bucket, key, f)
         f.close()
 
-        with open('/tmp/GeoLite2-ASN.mmdb', 'wb') as w:
-            with tarfile.open('/tmp/maxmind2.tar.gz', 'r:gz') as tar:
-                for member in tar.getmembers():
-                    if os.path.splitext(member.name)[1] == '.mmdb':
-                        r = tar.extractfile(member)
-                        if r is not None:
-                            content = r.read()
-                            r.close()
-                            w.write(content)
-            tar.close()
-        w.close()
-
-        response = s3_client.upload_file('/tmp/asn.updated',os.environ['S3_STAGED'],'asn.updated')
-        response = s3_client.upload_file('/tmp/GeoLite2-ASN.mmdb',os.environ['S3_STAGED'],'GeoLite2-ASN.mmdb')
-        response = s3_client.upload_file('/tmp/asn.updated',os.environ['S3_RESEARCH'],year+'/'+month+'/'+day+'/'+hour+'/asn.updated')
-        response = s3_client.upload_file('/tmp/GeoLite2-ASN.mmdb',os.environ['S3_RESEARCH'],year+'/'+month+'/'+day+'/'+hour+'/GeoLite2-ASN.mmdb')
-
-        ssm.put_parameter(
-            Name = os.environ['SSM_PARAMETER_ASN'],
-            Value = update.headers['last-modified'],
-            Type = 'String',
-            Overwrite = True
+    return task
+
+def deploy(client, function, bucket):
+
+    return lambda: client.update_function_code(
+        FunctionName = function,
+        S3Bucket = bucket,
+        S3Key = 'geoip2.zip'
     )
 
-    print("Copying GeoLite2-ASN.mmdb")
+def retire(s3_client, bucket, current):
 
-    with open('/tmp/GeoLite2-ASN.mmdb', 'wb') as f:
-        s3_client.download_fileobj(os.environ['S3_STAGED'], 'GeoLite2-ASN.mmdb', f) 
-    f.close()
+    # Tags every versions/ object outside the current prefix so the staged
+    # bucket lifecycle rule expires it; the live version is never tagged.
 
-    print("Copying GeoLite2-City.mmdb")
+    def task():
+        retired = 0
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket = bucket, Prefix = 'versions/'):
+            for item in page.get('Contents', []):
+                if not item['Key'].startswith(current):
+                    s3_client.put_object_tagging(
+                        Bucket = bucket,
+                        Key = item['Key'],
+                        Tagging = {'TagSet': [{'Key': 'retired', 'Value': 'true'}]}
+                    )
+                    retired += 1
+        return retired
 
-    with open('/tmp/GeoLite2-City.mmdb', 'wb') as f:
-        s3_client.download_fileobj(os.environ['S3_STAGED'], 'GeoLite2-City.mmdb', f) 
-    f.close()
+    return task
 
-    print("Copying search.py")
+def fingerprint(s3_client, keys):
 
-    with open('/tmp/search.py', 'wb') as f:
-        s3_client.download_fileobj(os.environ['S3_STAGED'], 'search.py', f) 
-    f.close()
+    digest = hashlib.sha256()
 
-    print("Packaging geoip2.zip")
+    for key in keys:
+        head = s3_client.head_object(Bucket = os.environ['S3_STAGED'], Key = key)
+        digest.update((key+':'+head['ETag']+'\n').encode())
 
-    with zipfile.ZipFile('/tmp/geoip2.zip', 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zipf:
+    path = os.path.dirname(os.path.abspath(__file__))
 
-        zipf.write('/tmp/asn.updated','asn.updated')
-        zipf.write('/tmp/city.updated','city.updated')
-        zipf.write('/tmp/search.py','search.py')
-        zipf.write('/tmp/GeoLite2-ASN.mmdb','GeoLite2-ASN.mmdb')
-        zipf.write('/tmp/GeoLite2-City.mmdb','GeoLite2-City.mmdb')
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.py'):
+            with open(os.path.join(path, name), 'rb') as f:
+                digest.update((name+':').encode())
+                digest.update(f.read())
 
-        for root, dirs, files in os.walk('/tmp/geoip2'):
-            for file in files:
-                fullpath = os.path.join(root, file)
-                zipf.write(fullpath, fullpath[5:])
+    return digest.hexdigest()
 
-        for root, dirs, files in os.walk('/tmp/maxminddb'):
-            for file in files:
-                fullpath = os.path.join(root, file)
-                zipf.write(fullpath, fullpath[5:])
+def manifest(s3_client, bucket):
 
-    zipf.close()
+    try:
+        response = s3_client.get_object(Bucket = bucket, Key = 'manifest.json')
+        return json.loads(response['Body'].read())
+    except s3_client.exceptions.ClientError:
+        return {}
 
-    response = s3_client.upload_file('/tmp/geoip2.zip',os.environ['S3_STAGED'],'geoip2.zip')
+def handler(event, context):
 
-    s3_client = boto3.client('s3', region_name = 'us-east-1')
+    secret = boto3.client('secretsmanager')
 
-    response = s3_client.upload_file('/tmp/geoip2.zip',os.environ['S3_USE1'],'geoip2.zip')
- 
-    s3_client = boto3.client('s3', region_name = 'us-west-2')
+    getsecret = secret.get_secret_value(
+        SecretId = os.environ['SECRET_MGR_ARN']
+    )
 
-    response = s3_client.upload_file('/tmp/geoip2.zip',os.environ['S3_USW2'],'geoip2.zip')
+    login = json.loads(getsecret['SecretString'])
 
-    client = boto3.client('lambda', region_name = 'us-east-1')
+    ssm = boto3.client('ssm')
 
-    print("Updating "+os.environ['LAMBDA_FUNCTION_USE1'])
+    s3_client = boto3.client('s3')
 
-    response = client.update_function_code(
-        FunctionName = os.environ['LAMBDA_FUNCTION_USE1'],
-        S3Bucket = os.environ['S3_USE1'],
-        S3Key = 'geoip2.zip'
+    year = datetime.datetime.now().strftime('%Y')
+    month = datetime.datetime.now().strftime('%m')
+    day = datetime.datetime.now().strftime('%d')
+    hour = datetime.datetime.now().strftime('%H')
+
+    prefix = year+'/'+month+'/'+day+'/'+hour+'/'
+
+    refreshed = stage('Download', {
+        'City': lambda: refresh('City', os.environ['SSM_PARAMETER_CITY'], login, ssm, s3_client, prefix),
+        'ASN': lambda: refresh('ASN', os.environ['SSM_PARAMETER_ASN'], login, ssm, s3_client, prefix)
+    })
+
+    added = timed('Cataloging catalog.json', lambda: catalog.build(s3_client, os.environ['S3_RESEARCH']))
+
+    print('Cataloged snapshots:', added)
+
+    package = ssm.get_parameter(
+        Name = os.environ['SSM_PARAMETER_PACKAGE'],
+        WithDecryption = False
     )
 
-    client = boto3.client('lambda', region_name = 'us-west-2')
+    digest = fingerprint(s3_client, DATA + CODE)
+    code = fingerprint(s3_client, CODE)
 
-    print("Updating "+os.environ['LAMBDA_FUNCTION_USW2'])
+    print('Package:', digest)
+    print('Code:', code)
 
-    response = client.update_function_code(
-        FunctionName = os.environ['LAMBDA_FUNCTION_USW2'],
-        S3Bucket = os.environ['S3_USW2'],
-        S3Key = 'geoip2.zip'
+    if package['Parameter']['Value'] == digest:
+
+        print("Package unchanged")
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps('This product includes GeoLite2 data created by MaxMind, available from https://www.maxmind.com.')
+        }
+
+    lambda_client = boto3.client('lambda')
+
+    lambda_client.invoke(
+        FunctionName = os.environ['BUILD_FUNCTION'],
+        InvocationType = 'Event',
+        Payload = json.dumps({
+            'prefix': prefix,
+            'refreshed': {name: release for name, release in refreshed.items() if release},
+            'version': digest,
+            'code': code
+        }).encode()
     )
 
+    print("Building "+digest)
+
     return {
         'statusCode': 200,
         'body': json.dumps('This product includes GeoLite2 data created by MaxMind, available from https://www.maxmind.com.')
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,559 @@
+import array
+import ipaddress
+import mmap
+import struct
+import time
+
+# MaxMind DB format: https://maxmind.github.io/MaxMind-DB/
+
+METADATA = b'\xab\xcd\xefMaxMind.com'
+
+POINTER = 1
+STRING = 2
+DOUBLE = 3
+BYTES = 4
+UINT16 = 5
+UINT32 = 6
+MAP = 7
+INT32 = 8
+UINT64 = 9
+UINT128 = 10
+ARRAY = 11
+BOOLEAN = 14
+FLOAT = 15
+
+# IPv6 blocks MaxMind points at the IPv4 subtree: IPv4-mapped, Teredo and
+# 6to4, for databases written here from scratch.
+
+ALIASES = (
+    (0xffff << 32, 96),
+    (0x2001 << 112, 32),
+    (0x2002 << 112, 16)
+)
+
+class Uint16(int):
+    pass
+
+class Uint64(int):
+    pass
+
+class Pointer(int):
+    pass
+
+def network(start, prefixlen):
+
+    if prefixlen >= 96 and start < 2 ** 32:
+        return ipaddress.IPv4Network((start, prefixlen - 96))
+
+    return ipaddress.IPv6Network((start, prefixlen))
+
+def cidrs(start, end):
+
+    while start <= end:
+        size = (start & -start).bit_length() - 1 if start else 128
+        while start + (1 << size) - 1 > end:
+            size -= 1
+        yield start, 128 - size
+        start += 1 << size
+
+class Decoder:
+
+    def __init__(self, buf, base):
+
+        self.buf = buf
+        self.base = base
+
+    def decode(self, offset):
+
+        ctrl = self.buf[offset]
+        offset += 1
+        kind = ctrl >> 5
+
+        if kind == POINTER:
+            size = (ctrl >> 3) & 0x3
+            value = ctrl & 0x7
+            if size == 0:
+                pointer = (value << 8) + self.buf[offset]
+            elif size == 1:
+                pointer = ((value << 16) | int.from_bytes(self.buf[offset:offset + 2], 'big')) + 2048
+            elif size == 2:
+                pointer = ((value << 24) | int.from_bytes(self.buf[offset:offset + 3], 'big')) + 526336
+            else:
+                pointer = int.from_bytes(self.buf[offset:offset + 4], 'big')
+            value, _ = self.decode(self.base + pointer)
+            return value, offset + size + 1
+
+        if kind == 0:
+            kind = 7 + self.buf[offset]
+            offset += 1
+
+        size = ctrl & 0x1f
+        if size >= 29:
+            extra = size - 28
+            value = int.from_bytes(self.buf[offset:offset + extra], 'big')
+            offset += extra
+            size = (29, 285, 65821)[extra - 1] + value
+
+        if kind == MAP:
+            value = {}
+            for _ in range(size):
+                key, offset = self.decode(offset)
+                value[key], offset = self.decode(offset)
+            return value, offset
+
+        if kind == ARRAY:
+            value = []
+            for _ in range(size):
+                item, offset = self.decode(offset)
+                value.append(item)
+            return value, offset
+
+        if kind == BOOLEAN:
+            return size != 0, offset
+
+        raw = self.buf[offset:offset + size]
+        offset += size
+
+        if kind == STRING:
+            return bytes(raw).decode('utf-8'), offset
+        if kind == DOUBLE:
+            return struct.unpack('>d', raw)[0], offset
+        if kind == FLOAT:
+            return struct.unpack('>f', raw)[0], offset
+        if kind == BYTES:
+            return bytes(raw), offset
+        if kind == INT32:
+            return int.from_bytes(raw.rjust(4, b'\x00'), 'big', signed = True), offset
+        if kind in (UINT16, UINT32, UINT64, UINT128):
+            return int.from_bytes(raw, 'big'), offset
+
+        raise ValueError('Unsupported MaxMind DB type '+str(kind))
+
+class Database:
+
+    def __init__(self, path):
+
+        self.path = path
+        self.file = open(path, 'rb')
+        self.buf = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        start = self.buf.rfind(METADATA)
+        self.metadata, _ = Decoder(self.buf, start + len(METADATA)).decode(start + len(METADATA))
+
+        self.node_count = self.metadata['node_count']
+        self.record_size = self.metadata['record_size']
+        self.ip_version = self.metadata['ip_version']
+        self.node_bytes = self.record_size // 4
+        self.tree_size = self.node_count * self.node_bytes
+        self.decoder = Decoder(self.buf, self.tree_size + 16)
+        self.records = {}
+        self.aliases = []
+
+        self.ipv4_start = 0
+        if self.ip_version == 6:
+            for _ in range(96):
+                if self.ipv4_start >= self.node_count:
+                    break
+                self.ipv4_start = self.read(self.ipv4_start, 0)
+
+    def read(self, node, side):
+
+        offset = node * self.node_bytes
+        buf = self.buf
+
+        if self.record_size == 24:
+            offset += side * 3
+            return (buf[offset] << 16) | (buf[offset + 1] << 8) | buf[offset + 2]
+
+        if self.record_size == 28:
+            if side == 0:
+                return ((buf[offset + 3] & 0xf0) << 20) | (buf[offset] << 16) | (buf[offset + 1] << 8) | buf[offset + 2]
+            return ((buf[offset + 3] & 0x0f) << 24) | (buf[offset + 4] << 16) | (buf[offset + 5] << 8) | buf[offset + 6]
+
+        offset += side * 4
+        return int.from_bytes(buf[offset:offset + 4], 'big')
+
+    def walk(self):
+
+        # Yields (start, prefixlen, offset) in ascending address order within
+        # the 128-bit space, with IPv4 networks at ::/96 like the search tree.
+        # Other pointers into the IPv4 subtree are aliases, recorded in
+        # self.aliases as (start, prefixlen) so a rewrite can replay them.
+
+        bits = 128 if self.ip_version == 6 else 32
+        shift = 0 if self.ip_version == 6 else 96
+        stack = [(0, 0, 0)]
+        self.aliases = []
+
+        while stack:
+            node, depth, acc = stack.pop()
+            if node > self.node_count:
+                yield acc << (bits - depth), depth + shift, node - self.node_count - 16
+            elif node < self.node_count:
+                if acc != 0 and node == self.ipv4_start:
+                    self.aliases.append((acc << (bits - depth), depth))
+                    continue
+                stack.append((self.read(node, 1), depth + 1, (acc << 1) | 1))
+                stack.append((self.read(node, 0), depth + 1, acc << 1))
+
+    def ranges(self):
+
+        for start, prefixlen, offset in self.walk():
+            yield start, start + (1 << (128 - prefixlen)) - 1, (prefixlen, offset)
+
+    def record(self, offset):
+
+        if offset not in self.records:
+            self.records[offset], _ = self.decoder.decode(self.tree_size + 16 + offset)
+
+        return self.records[offset]
+
+    def close(self):
+
+        self.buf.close()
+        self.file.close()
+
+def overlay(first, second):
+
+    # Merges two ascending streams of non-overlapping (start, end, value)
+    # ranges into (start, end, first value, second value) pieces.
+
+    a = next(first, None)
+    b = next(second, None)
+
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[1] < b[0]):
+            yield a[0], a[1], a[2], None
+            a = next(first, None)
+        elif a is None or b[1] < a[0]:
+            yield b[0], b[1], None, b[2]
+            b = next(second, None)
+        else:
+            start = max(a[0], b[0])
+            if a[0] < start:
+                yield a[0], start - 1, a[2], None
+            if b[0] < start:
+                yield b[0], start - 1, None, b[2]
+            end = min(a[1], b[1])
+            yield start, end, a[2], b[2]
+            a = next(first, None) if a[1] == end else (end + 1, a[1], a[2])
+            b = next(second, None) if b[1] == end else (end + 1, b[1], b[2])
+
+class Writer:
+
+    def __init__(self, ip_version = 6, dedupe = True):
+
+        self.ip_version = ip_version
+        self.bits = 128 if ip_version == 6 else 32
+        self.data = bytearray()
+        self.cache = {} if dedupe else None
+        self.left = array.array('q', [-1])
+        self.right = array.array('q', [-1])
+        self.path = [0]
+        self.last = 0
+
+    ### DATA SECTION ###
+
+    def store(self, value):
+
+        # A value already in the data section returns its offset rather than
+        # a pointer to it, so the offset can itself be the target of one.
+
+        if self.cache is not None and isinstance(value, (dict, list)):
+            key = self.key(value)
+            if key in self.cache:
+                return self.cache[key]
+
+        offset = len(self.data)
+        self.encode(value)
+        return offset
+
+    def key(self, value):
+
+        if isinstance(value, dict):
+            return ('map',) + tuple((k, self.key(v)) for k, v in value.items())
+        if isinstance(value, list):
+            return ('array',) + tuple(self.key(v) for v in value)
+        return (type(value).__name__, value)
+
+    def control(self, kind, size):
+
+        if kind > 7:
+            first = 0
+            extended = bytes([kind - 7])
+        else:
+            first = kind << 5
+            extended = b''
+
+        if size < 29:
+            return bytes([first | size]) + extended
+        if size < 285:
+            return bytes([first | 29]) + extended + bytes([size - 29])
+        if size < 65821:
+            return bytes([first | 30]) + extended + (size - 285).to_bytes(2, 'big')
+
+        return bytes([first | 31]) + extended + (size - 65821).to_bytes(3, 'big')
+
+    def pointer(self, offset):
+
+        if offset < 2048:
+            return bytes([0x20 | (offset >> 8), offset & 0xff])
+        if offset < 526336:
+            offset -= 2048
+            return bytes([0x28 | (offset >> 16)]) + (offset & 0xffff).to_bytes(2, 'big')
+        if offset < 134744064:
+            offset -= 526336
+            return bytes([0x30 | (offset >> 24)]) + (offset & 0xffffff).to_bytes(3, 'big')
+
+        return bytes([0x38]) + offset.to_bytes(4, 'big')
+
+    def encode(self, value):
+
+        if self.cache is not None and (isinstance(value, (dict, list)) or (isinstance(value, str) and len(value) > 2)):
+            key = self.key(value)
+            if key in self.cache:
+                self.data += self.pointer(self.cache[key])
+                return
+            self.cache[key] = len(self.data)
+
+        if isinstance(value, Pointer):
+            self.data += self.pointer(value)
+        elif isinstance(value, bool):
+            self.data += self.control(BOOLEAN, 1 if value else 0)
+        elif isinstance(value, str):
+            raw = value.encode('utf-8')
+            self.data += self.control(STRING, len(raw)) + raw
+        elif isinstance(value, float):
+            self.data += self.control(DOUBLE, 8) + struct.pack('>d', value)
+        elif isinstance(value, bytes):
+            self.data += self.control(BYTES, len(value)) + value
+        elif isinstance(value, int):
+            if value < 0:
+                raw = value.to_bytes(4, 'big', signed = True)
+                self.data += self.control(INT32, 4) + raw
+            else:
+                raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+                if isinstance(value, Uint16):
+                    kind = UINT16
+                elif isinstance(value, Uint64):
+                    kind = UINT64
+                else:
+                    kind = UINT32 if value < 2 ** 32 else UINT64 if value < 2 ** 64 else UINT128
+                self.data += self.control(kind, len(raw)) + raw
+        elif isinstance(value, dict):
+            self.data += self.control(MAP, len(value))
+            for k, v in value.items():
+                self.encode(k)
+                self.encode(v)
+        elif isinstance(value, list):
+            self.data += self.control(ARRAY, len(value))
+            for v in value:
+                self.encode(v)
+        else:
+            raise ValueError('Unsupported value '+repr(value))
+
+    ### SEARCH TREE ###
+
+    def insert(self, start, prefixlen, offset):
+
+        # Networks must arrive in ascending order without overlap, so only the
+        # part of the path that differs from the previous insert is rebuilt.
+
+        if self.ip_version == 4:
+            prefixlen -= 96
+
+        common = self.bits - (start ^ self.last).bit_length()
+        del self.path[min(common, prefixlen - 1, len(self.path) - 1) + 1:]
+
+        for depth in range(len(self.path), prefixlen):
+            node = len(self.left)
+            self.left.append(-1)
+            self.right.append(-1)
+            self.link(self.path[-1], start, depth - 1, node)
+            self.path.append(node)
+
+        self.link(self.path[prefixlen - 1], start, prefixlen - 1, -2 - offset)
+        self.last = start
+
+    def link(self, node, start, depth, value):
+
+        if (start >> (self.bits - 1 - depth)) & 1:
+            self.right[node] = value
+        else:
+            self.left[node] = value
+
+    def alias(self, start, prefixlen, target):
+
+        node = 0
+        for depth in range(prefixlen - 1):
+            side = self.right if (start >> (self.bits - 1 - depth)) & 1 else self.left
+            if side[node] == -1:
+                side[node] = len(self.left)
+                self.left.append(-1)
+                self.right.append(-1)
+            elif side[node] < 0:
+                return
+            node = side[node]
+
+        side = self.right if (start >> (self.bits - 1 - (prefixlen - 1))) & 1 else self.left
+        if side[node] == -1:
+            side[node] = target
+
+    def write(self, path, database_type, description, aliases = ALIASES):
+
+        # Aliases are (start, prefixlen) blocks pointed at the IPv4 subtree,
+        # the ones Database.walk() found when the tree is rebuilt from a
+        # source database.
+
+        if self.ip_version == 6:
+            node = 0
+            for _ in range(96):
+                if node < 0:
+                    break
+                node = self.left[node]
+            if node >= 0:
+                for start, prefixlen in aliases:
+                    self.alias(start, prefixlen, node)
+
+        count = len(self.left)
+
+        def resolve(value):
+            if value == -1:
+                return count
+            if value < 0:
+                return count + 16 - 2 - value
+            return value
+
+        largest = count + 16 + len(self.data)
+        record_size = 24 if largest < 2 ** 24 else 28 if largest < 2 ** 28 else 32
+
+        with open(path, 'wb') as f:
+
+            tree = bytearray()
+            for node in range(count):
+                left = resolve(self.left[node])
+                right = resolve(self.right[node])
+                if record_size == 24:
+                    tree += left.to_bytes(3, 'big') + right.to_bytes(3, 'big')
+                elif record_size == 28:
+                    tree += (left & 0xffffff).to_bytes(3, 'big')
+                    tree.append(((left >> 24) << 4) | (right >> 24))
+                    tree += (right & 0xffffff).to_bytes(3, 'big')
+                else:
+                    tree += left.to_bytes(4, 'big') + right.to_bytes(4, 'big')
+                if len(tree) > 1048576:
+                    f.write(tree)
+                    tree = bytearray()
+            f.write(tree)
+
+            f.write(bytes(16))
+            f.write(self.data)
+
+            metadata = Writer(dedupe = False)
+            metadata.encode({
+                'binary_format_major_version': Uint16(2),
+                'binary_format_minor_version': Uint16(0),
+                'build_epoch': Uint64(int(time.time())),
+                'database_type': database_type,
+                'description': {'en': description},
+                'ip_version': Uint16(self.ip_version),
+                'languages': ['en'],
+                'node_count': count,
+                'record_size': Uint16(record_size)
+            })
+            f.write(METADATA)
+            f.write(metadata.data)
+
+def slim(record):
+
+    # Keeps only the City fields the search API returns, in the same layout
+    # so geoip2 models and the merged build read it unchanged.
+
+    result = {}
+
+    if 'en' in record.get('city', {}).get('names', {}):
+        result['city'] = {'names': {'en': record['city']['names']['en']}}
+
+    country = {}
+    if 'iso_code' in record.get('country', {}):
+        country['iso_code'] = record['country']['iso_code']
+    if 'en' in record.get('country', {}).get('names', {}):
+        country['names'] = {'en': record['country']['names']['en']}
+    if country:
+        result['country'] = country
+
+    location = {}
+    for key in ('latitude', 'longitude'):
+        if key in record.get('location', {}):
+            location[key] = record['location'][key]
+    if location:
+        result['location'] = location
+
+    if 'code' in record.get('postal', {}):
+        result['postal'] = {'code': record['postal']['code']}
+
+    if record.get('subdivisions'):
+        subdivision = {}
+        if 'iso_code' in record['subdivisions'][-1]:
+            subdivision['iso_code'] = record['subdivisions'][-1]['iso_code']
+        if 'en' in record['subdivisions'][-1].get('names', {}):
+            subdivision['names'] = {'en': record['subdivisions'][-1]['names']['en']}
+        result['subdivisions'] = [subdivision]
+
+    return result
+
+def rewrite(source, path, transform):
+
+    database = Database(source)
+    writer = Writer(database.ip_version)
+    offsets = {}
+
+    for start, prefixlen, offset in database.walk():
+        if offset not in offsets:
+            offsets[offset] = writer.store(transform(database.record(offset)))
+        writer.insert(start, prefixlen, offsets[offset])
+
+    writer.write(path, database.metadata['database_type'], database.metadata.get('description', {}).get('en', ''), database.aliases)
+
+    database.close()
+
+def merge(citypath, asnpath, path):
+
+    city = Database(citypath)
+    asn = Database(asnpath)
+    writer = Writer()
+    offsets = {}
+    cities = {}
+    asns = {}
+
+    # Each leaf stores how many bits shorter the City and ASN networks are
+    # than the leaf itself. The reader reports the leaf prefix in whatever
+    # space the query walked, native IPv4 or one of the IPv6 aliases, so
+    # subtracting the delta gives the network in that same space. Source
+    # records are stored once and each leaf record points at them.
+
+    for start, end, geo, org in overlay(city.ranges(), asn.ranges()):
+
+        for first, prefixlen in cidrs(start, end):
+
+            key = (geo, org, prefixlen - geo[0] if geo is not None else None, prefixlen - org[0] if org is not None else None)
+            if key not in offsets:
+                record = {}
+                if geo is not None:
+                    if geo[1] not in cities:
+                        cities[geo[1]] = Pointer(writer.store(city.record(geo[1])))
+                    record['city'] = cities[geo[1]]
+                    record['city_delta'] = key[2]
+                if org is not None:
+                    if org[1] not in asns:
+                        asns[org[1]] = Pointer(writer.store(asn.record(org[1])))
+                    record['asn'] = asns[org[1]]
+                    record['asn_delta'] = key[3]
+                offsets[key] = writer.store(record)
+
+            writer.insert(first, prefixlen, offsets[key])
+
+    writer.write(path, 'GeoLite2-Merged', 'GeoLite2 City and ASN merged by network', sorted(set(city.aliases) | set(asn.aliases)))
+
+    city.close()
+    asn.close()
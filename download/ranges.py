@@ -0,0 +1,85 @@
+import array
+import json
+import numpy
+
+import mmdb
+
+def fields(record):
+
+    if 'autonomous_system_number' in record:
+        return {
+            'id': record.get('autonomous_system_number'),
+            'org': record.get('autonomous_system_organization')
+        }
+
+    subdivision = (record.get('subdivisions') or [{}])[-1]
+
+    return {
+        'country':record.get('country', {}).get('names', {}).get('en'),
+        'c_iso':record.get('country', {}).get('iso_code'),
+        'state':subdivision.get('names', {}).get('en'),
+        's_iso':subdivision.get('iso_code'),
+        'city':record.get('city', {}).get('names', {}).get('en'),
+        'zip':record.get('postal', {}).get('code'),
+        'latitude':record.get('location', {}).get('latitude'),
+        'longitude':record.get('location', {}).get('longitude')
+    }
+
+def build(source, path):
+
+    # Flattens a GeoLite2 database into sorted start/end/prefix/record arrays
+    # per IP version and a deduplicated JSON record table, saved as .npz.
+
+    database = mmdb.Database(source)
+
+    v4start = array.array('I')
+    v4end = array.array('I')
+    v4prefix = array.array('B')
+    v4record = array.array('I')
+    v6start = bytearray()
+    v6end = bytearray()
+    v6prefix = array.array('B')
+    v6record = array.array('I')
+
+    ids = {}
+    keys = {}
+    records = []
+
+    for start, prefixlen, offset in database.walk():
+
+        if offset not in ids:
+            record = fields(database.record(offset))
+            key = json.dumps(record, sort_keys = True)
+            if key not in keys:
+                keys[key] = len(records)
+                records.append(record)
+            ids[offset] = keys[key]
+
+        end = start + (1 << (128 - prefixlen)) - 1
+
+        if prefixlen >= 96 and start < 2 ** 32:
+            v4start.append(start)
+            v4end.append(end)
+            v4prefix.append(prefixlen - 96)
+            v4record.append(ids[offset])
+        else:
+            v6start += start.to_bytes(16, 'big')
+            v6end += end.to_bytes(16, 'big')
+            v6prefix.append(prefixlen)
+            v6record.append(ids[offset])
+
+    database.close()
+
+    with open(path, 'wb') as f:
+        numpy.savez(
+            f,
+            v4start = numpy.frombuffer(v4start, dtype = numpy.uint32),
+            v4end = numpy.frombuffer(v4end, dtype = numpy.uint32),
+            v4prefix = numpy.frombuffer(v4prefix, dtype = numpy.uint8),
+            v4record = numpy.frombuffer(v4record, dtype = numpy.uint32),
+            v6start = numpy.frombuffer(bytes(v6start), dtype = 'S16'),
+            v6end = numpy.frombuffer(bytes(v6end), dtype = 'S16'),
+            v6prefix = numpy.frombuffer(v6prefix, dtype = numpy.uint8),
+            v6record = numpy.frombuffer(v6record, dtype = numpy.uint32),
+            records = numpy.frombuffer(json.dumps(records).encode(), dtype = numpy.uint8)
+        )
@@ -0,0 +1,66 @@
+import array
+import struct
+
+import mmdb
+
+# ASN reverse index layout (little-endian):
+#   header    magic, ASN count, network count, org entry count
+#   asns      sorted uint32 ASN numbers
+#   first     ASN count + 1 uint32 positions into the network arrays
+#   starts    16 byte big-endian network addresses, IPv4 at ::/96
+#   prefixes  uint8 prefix lengths in the 128-bit space
+#   orgasns   uint32 ASN per org entry, entries sorted by lowercase name
+#   names     org entry count + 1 uint32 positions into the name blob
+#   blob      UTF-8 organization names
+# Networks of each ASN are stored in ascending address order.
+
+MAGIC = b'ASNREV\x00\x01'
+
+def build(source, path):
+
+    database = mmdb.Database(source)
+
+    networks = {}
+    orgs = {}
+
+    for start, prefixlen, offset in database.walk():
+        record = database.record(offset)
+        number = record.get('autonomous_system_number')
+        if number is None:
+            continue
+        networks.setdefault(number, []).append((start, prefixlen))
+        orgs.setdefault(number, record.get('autonomous_system_organization') or '')
+
+    database.close()
+
+    asns = array.array('I', sorted(networks))
+    first = array.array('I', [0])
+    starts = bytearray()
+    prefixes = bytearray()
+
+    for number in asns:
+        for start, prefixlen in networks[number]:
+            starts += start.to_bytes(16, 'big')
+            prefixes.append(prefixlen)
+        first.append(len(prefixes))
+
+    entries = sorted((org.lower(), number, org) for number, org in orgs.items() if org != '')
+    orgasns = array.array('I', [number for _, number, _ in entries])
+    names = array.array('I', [0])
+    blob = bytearray()
+
+    for _, _, org in entries:
+        blob += org.encode()
+        names.append(len(blob))
+
+    padding = b'\x00' * (-len(prefixes) % 4)
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<III', len(asns), len(prefixes), len(entries)))
+        for section in (asns, first):
+            f.write(struct.pack('<'+str(len(section))+'I', *section))
+        f.write(bytes(starts))
+        f.write(bytes(prefixes) + padding)
+        for section in (orgasns, names):
+            f.write(struct.pack('<'+str(len(section))+'I', *section))
+        f.write(bytes(blob))
@@ -0,0 +1,81 @@
+import array
+import json
+import math
+import numpy
+
+import mmdb
+import ranges
+
+# One-degree latitude/longitude grid over the distinct City locations:
+#   cells     64800 + 1 positions into the location arrays, row major from
+#             -90 latitude and -180 longitude
+#   latitude  float64 per location, locations sorted by cell
+#   longitude float64 per location
+#   first     location count + 1 positions into the network arrays
+#   starts    16 byte big-endian network addresses, IPv4 at ::/96
+#   prefixes  uint8 prefix lengths in the 128-bit space
+#   records   JSON list of the location fields, one per location
+
+def cell(latitude, longitude):
+
+    row = min(int(math.floor(latitude)) + 90, 179)
+    column = min(int(math.floor(longitude)) + 180, 359)
+
+    return row * 360 + column
+
+def build(source, path):
+
+    database = mmdb.Database(source)
+
+    ids = {}
+    keys = {}
+    records = []
+    networks = []
+
+    for start, prefixlen, offset in database.walk():
+
+        if offset not in ids:
+            record = ranges.fields(database.record(offset))
+            ids[offset] = None
+            if record['latitude'] is not None and record['longitude'] is not None:
+                key = json.dumps(record, sort_keys = True)
+                if key not in keys:
+                    keys[key] = len(records)
+                    records.append(record)
+                    networks.append([])
+                ids[offset] = keys[key]
+
+        if ids[offset] is not None:
+            networks[ids[offset]].append((start, prefixlen))
+
+    database.close()
+
+    order = sorted(range(len(records)), key = lambda index: cell(records[index]['latitude'], records[index]['longitude']))
+
+    cells = numpy.zeros(64801, dtype = numpy.uint32)
+    latitude = array.array('d')
+    longitude = array.array('d')
+    first = array.array('I', [0])
+    starts = bytearray()
+    prefixes = array.array('B')
+
+    for index in order:
+        cells[cell(records[index]['latitude'], records[index]['longitude']) + 1] += 1
+        latitude.append(records[index]['latitude'])
+        longitude.append(records[index]['longitude'])
+        for start, prefixlen in networks[index]:
+            starts += start.to_bytes(16, 'big')
+            prefixes.append(prefixlen)
+        first.append(len(prefixes))
+
+    with open(path, 'wb') as f:
+        numpy.savez(
+            f,
+            cells = numpy.cumsum(cells, dtype = numpy.uint32),
+            latitude = numpy.frombuffer(latitude, dtype = numpy.float64),
+            longitude = numpy.frombuffer(longitude, dtype = numpy.float64),
+            first = numpy.frombuffer(first, dtype = numpy.uint32),
+            starts = numpy.frombuffer(bytes(starts), dtype = 'S16'),
+            prefixes = numpy.frombuffer(prefixes, dtype = numpy.uint8),
+            records = numpy.frombuffer(json.dumps([records[index] for index in order]).encode(), dtype = numpy.uint8)
+        )
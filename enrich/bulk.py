@@ -0,0 +1,355 @@
+import functools
+import ipaddress
+import json
+import mmap
+import numpy
+import os
+import socket
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+import search
+
+# A shared index file holds the same arrays as the .npz plus the records
+# re-encoded as an offsets array and one JSON blob, each page aligned after
+# a JSON header, so worker processes map it read-only and share the pages.
+
+MAGIC = b'GEORANGE'
+
+# IPv6 forms the GeoLite2 trees answer from the IPv4 subtree: IPv4-compatible
+# ::/96, IPv4-mapped ::ffff:0:0/96 and 6to4 2002::/16, as base and length.
+
+ALIASES = (
+    ('compat', 0, 96),
+    ('mapped', 0xffff << 32, 96),
+    ('6to4', 0x2002 << 112, 16)
+)
+ARRAYS = ('v4start', 'v4end', 'v4prefix', 'v4record', 'v6start', 'v6end', 'v6prefix', 'v6record', 'offsets', 'blob')
+
+def tables(path):
+
+    arrays = {}
+
+    with numpy.load(path) as data:
+        for name in ARRAYS[:8]:
+            arrays[name] = data[name]
+        records = json.loads(data['records'].tobytes())
+
+    encoded = [json.dumps(record).encode() for record in records]
+    arrays['offsets'] = numpy.zeros(len(encoded) + 1, dtype = numpy.uint64)
+    arrays['offsets'][1:] = numpy.cumsum([len(record) for record in encoded])
+    arrays['blob'] = numpy.frombuffer(b''.join(encoded), dtype = numpy.uint8)
+
+    return arrays
+
+def share(source, path):
+
+    # Converts a .npz range index into a shared index file once; every
+    # RangeIndex opened on it maps the same page cache instead of copying.
+
+    arrays = tables(source)
+    layout = []
+    offset = 0
+
+    for name in ARRAYS:
+        layout.append([name, arrays[name].dtype.str, list(arrays[name].shape), offset])
+        offset += -(-arrays[name].nbytes // mmap.PAGESIZE) * mmap.PAGESIZE
+
+    header = json.dumps(layout).encode()
+    start = -(-(len(MAGIC) + 4 + len(header)) // mmap.PAGESIZE) * mmap.PAGESIZE
+
+    with open(path+'.part', 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        for name, dtype, shape, offset in layout:
+            f.seek(start + offset)
+            f.write(arrays[name].tobytes())
+        f.truncate(start + offset + arrays[ARRAYS[-1]].nbytes)
+
+    os.replace(path+'.part', path)
+
+    return path
+
+def attach(path):
+
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    if buf[:len(MAGIC)] != MAGIC:
+        raise ValueError('Invalid shared range index '+path)
+
+    size = struct.unpack_from('<I', buf, len(MAGIC))[0]
+    layout = json.loads(buf[len(MAGIC) + 4:len(MAGIC) + 4 + size])
+    start = -(-(len(MAGIC) + 4 + size) // mmap.PAGESIZE) * mmap.PAGESIZE
+
+    arrays = {}
+    for name, dtype, shape, offset in layout:
+        count = int(numpy.prod(shape))
+        arrays[name] = numpy.frombuffer(buf, dtype = dtype, count = count, offset = start + offset).reshape(shape)
+
+    return arrays
+
+class RangeIndex:
+
+    def __init__(self, path):
+
+        # .npz files are loaded into this process, shared index files from
+        # share() are mapped read-only.
+
+        if path.endswith('.npz'):
+            arrays = tables(path)
+        else:
+            arrays = attach(path)
+
+        self.v4start = arrays['v4start']
+        self.v4end = arrays['v4end']
+        self.v4prefix = arrays['v4prefix']
+        self.v4record = arrays['v4record']
+        self.v6start = arrays['v6start']
+        self.v6end = arrays['v6end']
+        self.v6prefix = arrays['v6prefix']
+        self.v6record = arrays['v6record']
+        self.offsets = arrays['offsets']
+        self.blob = arrays['blob']
+        self.decode = functools.lru_cache(maxsize = 65536)(self.load)
+
+    def search4(self, values):
+
+        # values: uint32 array of IPv4 addresses; returns range positions, -1 when absent
+
+        if len(self.v4start) == 0:
+            return numpy.full(len(values), -1, dtype = numpy.int64)
+
+        pos = numpy.searchsorted(self.v4start, values, side = 'right') - 1
+        clipped = numpy.maximum(pos, 0)
+        found = (pos >= 0) & (values <= self.v4end[clipped])
+        return numpy.where(found, pos, -1)
+
+    def search6(self, values):
+
+        # values: S16 array of big-endian IPv6 addresses; returns range positions, -1 when absent
+
+        if len(self.v6start) == 0:
+            return numpy.full(len(values), -1, dtype = numpy.int64)
+
+        pos = numpy.searchsorted(self.v6start, values, side = 'right') - 1
+        clipped = numpy.maximum(pos, 0)
+        found = (pos >= 0) & (values <= self.v6end[clipped])
+        return numpy.where(found, pos, -1)
+
+    def network(self, version, pos):
+
+        if version == 4:
+            return ipaddress.IPv4Network((int(self.v4start[pos]), int(self.v4prefix[pos])))
+
+        return ipaddress.IPv6Network((int.from_bytes(self.v6start[pos].ljust(16, b'\x00'), 'big'), int(self.v6prefix[pos])))
+
+    def load(self, index):
+
+        return json.loads(self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes())
+
+    def record(self, version, pos):
+
+        if version == 4:
+            return self.decode(int(self.v4record[pos]))
+
+        return self.decode(int(self.v6record[pos]))
+
+def fold(value):
+
+    # Returns the alias form and embedded IPv4 value of an IPv6 value in one
+    # of the ALIASES, otherwise None and the value unchanged.
+
+    for name, base, length in ALIASES:
+        if value >> (128 - length) == base >> (128 - length):
+            return name, (value >> (96 - length)) & 0xffffffff
+
+    return None, value
+
+def alias(ip, network):
+
+    # Network of the IPv4 subtree as the search function reports it for ip,
+    # inside the IPv6 alias block when ip is an IPv6 form of IPv4.
+
+    if ip.version == 4 or network.version == 6:
+        return network
+
+    for name, base, length in ALIASES:
+        if name == fold(int(ip))[0]:
+            return ipaddress.IPv6Network((base | (int(network.network_address) << (96 - length)), length + network.prefixlen))
+
+def pack(addresses):
+
+    # Splits address strings into uint32 IPv4 and S16 IPv6 arrays plus the
+    # input positions of each, and the positions of unparseable entries.
+
+    v4 = []
+    v4index = []
+    v6 = []
+    v6index = []
+    invalid = []
+
+    for index, address in enumerate(addresses):
+        address = str(address).strip()
+        try:
+            v4.append(socket.inet_pton(socket.AF_INET, address))
+            v4index.append(index)
+        except OSError:
+            try:
+                packed = socket.inet_pton(socket.AF_INET6, address)
+            except OSError:
+                invalid.append(index)
+                continue
+            name, value = fold(int.from_bytes(packed, 'big'))
+            if name is None:
+                v6.append(packed)
+                v6index.append(index)
+            else:
+                v4.append(value.to_bytes(4, 'big'))
+                v4index.append(index)
+
+    return (
+        numpy.frombuffer(b''.join(v4), dtype = '>u4').astype(numpy.uint32),
+        numpy.array(v4index, dtype = numpy.int64),
+        numpy.frombuffer(b''.join(v6), dtype = 'S16'),
+        numpy.array(v6index, dtype = numpy.int64),
+        invalid
+    )
+
+def lookup(city, asn, addresses):
+
+    # Resolves a list of address strings against City and ASN range indexes
+    # with one searchsorted call per index and IP version.
+
+    addresses = list(addresses)
+    v4, v4index, v6, v6index, invalid = pack(addresses)
+    results = [None] * len(addresses)
+
+    for index in invalid:
+        results[index] = {
+            'ip': addresses[index],
+            'error': 'invalid ip address'
+        }
+
+    for version, values, positions in ((4, v4, v4index), (6, v6, v6index)):
+
+        if len(values) == 0:
+            continue
+
+        citypos = city.search4(values) if version == 4 else city.search6(values)
+        asnpos = asn.search4(values) if version == 4 else asn.search6(values)
+
+        for index, geo, org in zip(positions.tolist(), citypos.tolist(), asnpos.tolist()):
+            results[index] = result(city, asn, ipaddress.ip_address(addresses[index].strip()), geo, org)
+
+    return results
+
+def result(city, asn, ip, geo, org):
+
+    # Same document as a search function batch result for one address,
+    # including the reserved block that search answers without a lookup.
+
+    block = search.special(ip)
+    if block is not None:
+        geo = org = -1
+
+    version = 4 if ip.version == 4 or fold(int(ip))[0] is not None else 6
+
+    if geo >= 0:
+        georecord = dict(city.record(version, geo), cidr = str(alias(ip, city.network(version, geo))))
+    else:
+        georecord = search.citymap({}, None)
+
+    if org >= 0:
+        asnrecord = dict(asn.record(version, org), net = str(alias(ip, asn.network(version, org))))
+    else:
+        asnrecord = search.asnmap({}, None)
+
+    msg = {'ip': str(ip)}
+
+    if block is not None:
+        msg['reserved'] = block[1]
+
+    msg['geo'] = georecord
+    msg['asn'] = asnrecord
+
+    return msg
+
+class Cursor:
+
+    # Forward-only position in one index's ranges for one IP version.
+
+    def __init__(self, index, version):
+
+        self.version = version
+        self.starts = index.v4start if version == 4 else index.v6start
+        self.ends = index.v4end if version == 4 else index.v6end
+        self.pos = 0
+        self.last = -1
+        self.end = self.value(self.ends, 0)
+
+    def value(self, array, pos):
+
+        if pos >= len(array):
+            return None
+
+        if self.version == 4:
+            return int(array[pos])
+
+        return int.from_bytes(array[pos].ljust(16, b'\x00'), 'big')
+
+    def seek(self, value):
+
+        if value < self.last:
+            raise ValueError('IPv'+str(self.version)+' addresses are not sorted')
+        self.last = value
+
+        while self.end is not None and self.end < value:
+            self.pos += 1
+            self.end = self.value(self.ends, self.pos)
+
+        if self.end is not None and self.value(self.starts, self.pos) <= value:
+            return self.pos
+
+        return -1
+
+class Join:
+
+    # Merge-joins a sorted address stream against the City and ASN ranges in
+    # one forward pass. Each IP version only has to be sorted within itself,
+    # so IPv4 and IPv6 may be interleaved. IPv6 forms of IPv4 run on their
+    # own IPv4 cursors, which sorted IPv6 input keeps ascending.
+
+    def __init__(self, city, asn):
+
+        self.city = city
+        self.asn = asn
+        self.cursors = {
+            4: (Cursor(city, 4), Cursor(asn, 4)),
+            6: (Cursor(city, 6), Cursor(asn, 6))
+        }
+        for name, base, length in ALIASES:
+            self.cursors[name] = (Cursor(city, 4), Cursor(asn, 4))
+
+    def get(self, address):
+
+        try:
+            ip = ipaddress.ip_address(str(address).strip())
+        except ValueError:
+            return {
+                'ip': address,
+                'error': 'invalid ip address'
+            }
+
+        name, value = fold(int(ip)) if ip.version == 6 else (4, int(ip))
+        citycursor, asncursor = self.cursors[name or 6]
+
+        return result(self.city, self.asn, ip, citycursor.seek(value), asncursor.seek(value))
+
+def join(city, asn, addresses):
+
+    merge = Join(city, asn)
+
+    for address in addresses:
+        yield merge.get(address)
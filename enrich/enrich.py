@@ -0,0 +1,273 @@
+import argparse
+import collections
+import csv
+import json
+import multiprocessing
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+import bulk
+import search
+
+# Streams addresses from text, CSV or JSONL input through a pool of worker
+# processes running the search handler lookup logic. At most a fixed window
+# of chunks is in flight, so memory stays flat and output keeps input order.
+
+db = None
+selected = None
+
+def initialize(path, fields):
+
+    global db, selected
+
+    # Workers never read the databases into process memory: the mmap modes
+    # map the same page cache in every process, so workers add no copies.
+
+    mode = search.openmode()
+    if mode == 'memory':
+        mode = 'mmap'
+
+    db = search.Databases(path, mode)
+    selected = search.projection({'fields': fields})
+
+def work(items):
+
+    return search.batch(db, items, selected)
+
+def records(stream, kind, column):
+
+    # Yields (row, address, error). A row without the address column, or a
+    # JSONL line that is not an object, keeps its place in the output as an
+    # error naming its line. A CSV header without the column raises
+    # ValueError before any row.
+
+    if kind == 'text':
+        for line in stream:
+            ip = line.strip()
+            if ip != '':
+                yield None, ip, None
+
+    elif kind == 'csv':
+        reader = csv.reader(stream)
+        header = next(reader, [])
+        if not column.isdigit() and column not in header:
+            raise ValueError('no '+column+' column, columns are '+', '.join(header))
+        index = int(column) if column.isdigit() else header.index(column)
+        yield header, None, None
+        for row in reader:
+            if len(row) > index:
+                yield row, row[index].strip(), None
+            else:
+                yield row, None, 'line '+str(reader.line_num)+': no '+column+' column'
+
+    else:
+        for number, line in enumerate(stream, 1):
+            if line.strip() != '':
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    yield None, None, 'line '+str(number)+': invalid JSON'
+                    continue
+                if not isinstance(row, dict):
+                    yield None, None, 'line '+str(number)+': not a JSON object'
+                elif column in row:
+                    yield row, str(row[column]).strip(), None
+                else:
+                    yield row, None, 'line '+str(number)+': no '+column+' field'
+
+def chunks(rows, size):
+
+    chunk = []
+
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+def columns(selected):
+
+    names = ['reserved', 'error']
+
+    for side in selected:
+        for key in selected[side]:
+            names.append(side+'.'+key)
+
+    return names
+
+def flatten(result, names):
+
+    row = []
+
+    for name in names:
+        if name == 'reserved':
+            row.append((result.get('reserved') or {}).get('name', ''))
+        elif name == 'error':
+            row.append(result.get('error', ''))
+        else:
+            side, key = name.split('.')
+            value = result.get(side, {}).get(key)
+            row.append('' if value is None else value)
+
+    return row
+
+def writer(stream, kind, output, selected, header, first):
+
+    names = columns(selected)
+
+    if output == 'jsonl':
+
+        def emit(row, result):
+            if isinstance(row, dict):
+                result = dict(row, **{key: value for key, value in result.items() if key != 'ip'})
+            elif row is not None:
+                result = dict(zip(header, row), **{key: value for key, value in result.items() if key != 'ip'})
+            stream.write(json.dumps(result)+'\n')
+
+        return emit
+
+    out = csv.writer(stream)
+
+    if first and kind == 'csv':
+        out.writerow(header + names)
+    elif first:
+        out.writerow(['ip'] + names)
+
+    def emit(row, result):
+        if kind == 'csv':
+            out.writerow(row + [''] * (len(header) - len(row)) + flatten(result, names))
+        else:
+            out.writerow([result['ip']] + flatten(result, names))
+
+    return emit
+
+def ranges(path, name):
+
+    if os.path.exists(os.path.join(path, name+'.idx')):
+        return bulk.RangeIndex(os.path.join(path, name+'.idx'))
+
+    return bulk.RangeIndex(os.path.join(path, name+'.npz'))
+
+def narrow(selected, result):
+
+    if selected is search.FIELDS or 'error' in result:
+        return result
+
+    msg = {key: value for key, value in result.items() if key not in search.FIELDS}
+    msg.update(search.project(selected, result['geo'], result['asn']))
+
+    return msg
+
+def failure(ip, error):
+
+    return {'ip': ip or '', 'error': error}
+
+def drain(pending):
+
+    chunk, emit, task = pending.popleft()
+    results = iter(task.get())
+
+    for row, ip, error in chunk:
+        emit(row, failure(ip, error) if error is not None else next(results))
+
+def begin(parser, rows, kind, name):
+
+    if kind != 'csv':
+        return None
+
+    try:
+        return next(rows)[0]
+    except ValueError as e:
+        parser.error(name+': '+str(e))
+
+def merge(parser, args, selected):
+
+    # Sorted input needs no workers: one forward pass over the address stream
+    # and both range indexes, reading each range at most once.
+
+    path = args.ranges or args.databases
+    city = ranges(path, 'GeoLite2-City')
+    asn = ranges(path, 'GeoLite2-ASN')
+
+    for count, name in enumerate(args.input or ['-']):
+
+        stream = sys.stdin if name == '-' else open(name, 'r', newline = '')
+        rows = records(stream, args.format, args.column)
+
+        header = begin(parser, rows, args.format, name)
+
+        emit = writer(sys.stdout, args.format, args.output, selected, header, count == 0)
+        join = bulk.Join(city, asn)
+
+        try:
+            for row, ip, error in rows:
+                emit(row, failure(ip, error) if error is not None else narrow(selected, join.get(ip)))
+        except ValueError as e:
+            sys.exit(name+': '+str(e))
+
+        if stream is not sys.stdin:
+            stream.close()
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Enrich IP addresses with GeoLite2 City and ASN data.')
+    parser.add_argument('input', nargs = '*', help = 'input files, stdin when omitted')
+    parser.add_argument('--databases', default = os.environ.get('GEOLITE_PATH', '.'), help = 'directory holding an extracted geoip2.zip package')
+    parser.add_argument('--format', choices = ['text', 'csv', 'jsonl'], default = 'text', help = 'input format')
+    parser.add_argument('--column', default = 'ip', help = 'CSV column name or index, or JSONL field, holding the address')
+    parser.add_argument('--output', choices = ['jsonl', 'csv'], default = 'jsonl', help = 'output format')
+    parser.add_argument('--fields', default = '', help = 'comma separated fields, as the search API fields= parameter')
+    parser.add_argument('--processes', type = int, default = os.cpu_count(), help = 'worker processes')
+    parser.add_argument('--chunk', type = int, default = 5000, help = 'addresses per worker task')
+    parser.add_argument('--sorted', action = 'store_true', help = 'input is sorted per IP version, merge-join it against the range indexes')
+    parser.add_argument('--ranges', default = None, help = 'directory holding GeoLite2-City and GeoLite2-ASN .idx or .npz range indexes from the staged or research bucket, defaults to --databases')
+    args = parser.parse_args()
+
+    try:
+        selected = search.projection({'fields': args.fields})
+    except ValueError as e:
+        parser.error(str(e)+', fields are '+', '.join(side+'.'+key for side in search.FIELDS for key in search.FIELDS[side]))
+
+    if args.sorted:
+        path = args.ranges or args.databases
+        for name in ('GeoLite2-City', 'GeoLite2-ASN'):
+            if not os.path.exists(os.path.join(path, name+'.idx')) and not os.path.exists(os.path.join(path, name+'.npz')):
+                parser.error('--sorted needs '+name+'.idx or .npz in '+path+', the geoip2.zip package holds none, pass their directory with --ranges')
+        merge(parser, args, selected)
+        return
+
+    pool = multiprocessing.Pool(args.processes, initializer = initialize, initargs = (args.databases, args.fields))
+    pending = collections.deque()
+
+    for count, name in enumerate(args.input or ['-']):
+
+        stream = sys.stdin if name == '-' else open(name, 'r', newline = '')
+        rows = records(stream, args.format, args.column)
+
+        header = begin(parser, rows, args.format, name)
+
+        emit = writer(sys.stdout, args.format, args.output, selected, header, count == 0)
+
+        ### BOUNDED WINDOW OF IN-FLIGHT CHUNKS, DRAINED IN SUBMISSION ORDER ###
+
+        for chunk in chunks(rows, args.chunk):
+            pending.append((chunk, emit, pool.apply_async(work, ([ip for row, ip, error in chunk if error is None],))))
+            while len(pending) > args.processes * 2:
+                drain(pending)
+
+        while pending:
+            drain(pending)
+
+        if stream is not sys.stdin:
+            stream.close()
+
+    pool.close()
+    pool.join()
+
+if __name__ == '__main__':
+    main()
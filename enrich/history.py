@@ -0,0 +1,264 @@
+import argparse
+import bisect
+import boto3
+import collections
+import csv
+import datetime
+import email.utils
+import json
+import maxminddb
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+import search
+
+# As-of lookups against the dated snapshots in the research bucket. The
+# catalog.json written by the download job maps each instant to the City and
+# ASN snapshots that were current then; those .mmdb files are fetched on
+# first use into a local cache that evicts the least recently used files to
+# stay under a disk budget.
+
+UTC = datetime.timezone.utc
+
+def instant(value):
+
+    # datetime, epoch seconds, ISO 8601 or RFC 1123 text; naive times are UTC.
+
+    if isinstance(value, datetime.datetime):
+        when = value
+    else:
+        text = str(value).strip()
+        try:
+            when = datetime.datetime.fromtimestamp(float(text), UTC)
+        except (OverflowError, OSError, ValueError):
+            try:
+                when = datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+            except ValueError:
+                try:
+                    when = email.utils.parsedate_to_datetime(text)
+                except (TypeError, ValueError):
+                    raise ValueError('invalid timestamp')
+
+    if when.tzinfo is None:
+        when = when.replace(tzinfo = UTC)
+
+    return when.astimezone(UTC)
+
+def stamp(when):
+
+    return when.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+class Snapshot:
+
+    # Stands in for search.Databases, so the search lookup and batch logic
+    # runs unchanged against one historical City and ASN pair.
+
+    def __init__(self, city, asn, cityentry, asnentry):
+
+        self.city = city
+        self.asn = asn
+        self.merged = None
+        self.direct = None
+        self.cityupdated = 'City '+cityentry['prefix']
+        self.asnupdated = 'ASN '+asnentry['prefix']
+
+class History:
+
+    def __init__(self, bucket, path, budget, s3_client = None):
+
+        self.s3_client = s3_client or boto3.client('s3')
+        self.bucket = bucket
+        self.path = path
+        self.budget = budget
+
+        mode = search.openmode()
+        if mode == 'memory':
+            mode = 'mmap'
+        self.mode = search.MODES[mode]
+
+        response = self.s3_client.get_object(Bucket = bucket, Key = 'catalog.json')
+        self.catalog = json.loads(response['Body'].read())
+        self.times = {name: [instant(entry['time']).timestamp() for entry in entries] for name, entries in self.catalog.items()}
+
+        ### FILES LEFT BY EARLIER RUNS JOIN THE CACHE IN LAST USE ORDER ###
+
+        os.makedirs(path, exist_ok = True)
+
+        self.files = collections.OrderedDict()
+        self.readers = {}
+
+        for name in sorted(os.listdir(path), key = lambda name: os.path.getmtime(os.path.join(path, name))):
+            if name.endswith('.mmdb'):
+                self.files[name] = os.path.getsize(os.path.join(path, name))
+
+    def close(self):
+
+        for reader in self.readers.values():
+            reader.close()
+
+        self.readers.clear()
+
+    def entry(self, name, when):
+
+        pos = bisect.bisect_right(self.times.get(name, []), when.timestamp()) - 1
+
+        if pos < 0:
+            return None
+
+        return self.catalog[name][pos]
+
+    def local(self, name, entry):
+
+        return entry['prefix'].replace('/', '-')+'GeoLite2-'+name+'.mmdb'
+
+    def evict(self, size, keep):
+
+        # The snapshots of the pair being opened are never evicted, so a
+        # budget smaller than one pair is exceeded rather than thrashed.
+
+        total = sum(self.files.values())
+
+        for name in list(self.files):
+            if total + size <= self.budget:
+                break
+            if name in keep:
+                continue
+            total -= self.files.pop(name)
+            reader = self.readers.pop(name, None)
+            if reader is not None:
+                reader.close()
+            os.remove(os.path.join(self.path, name))
+
+    def open(self, name, entry, keep):
+
+        local = self.local(name, entry)
+        path = os.path.join(self.path, local)
+
+        if local not in self.files:
+            self.evict(entry['size'], keep)
+            print('Fetching '+entry['prefix']+'GeoLite2-'+name+'.mmdb', file = sys.stderr)
+            self.s3_client.download_file(self.bucket, entry['prefix']+'GeoLite2-'+name+'.mmdb', path+'.part')
+            os.replace(path+'.part', path)
+            self.files[local] = os.path.getsize(path)
+
+        self.files.move_to_end(local)
+        os.utime(path)
+
+        if local not in self.readers:
+            self.readers[local] = maxminddb.open_database(path, self.mode)
+
+        return self.readers[local]
+
+    def snapshot(self, cityentry, asnentry):
+
+        keep = {self.local('City', cityentry), self.local('ASN', asnentry)}
+
+        return Snapshot(
+            self.open('City', cityentry, keep),
+            self.open('ASN', asnentry, keep),
+            cityentry,
+            asnentry
+        )
+
+    def lookup(self, ip, when, selected = search.FIELDS):
+
+        return self.batch([(ip, when)], selected)[0]
+
+    def batch(self, items, selected = search.FIELDS):
+
+        # Items are (address, timestamp) pairs. They are grouped by snapshot
+        # pair and the groups run oldest first, so each pair is opened once
+        # and the search batch path still reuses networks within a group.
+
+        results = [None] * len(items)
+        groups = {}
+
+        for position, (item, value) in enumerate(items):
+            try:
+                when = instant(value)
+            except ValueError as e:
+                results[position] = {'ip': item, 'error': str(e)}
+                continue
+            cityentry = self.entry('City', when)
+            asnentry = self.entry('ASN', when)
+            if cityentry is None or asnentry is None:
+                results[position] = {'ip': item, 'as_of': stamp(when), 'error': 'no snapshot at or before '+stamp(when)}
+                continue
+            key = (cityentry['time'], asnentry['time'])
+            groups.setdefault(key, (cityentry, asnentry, []))[2].append((position, when))
+
+        for key in sorted(groups):
+            cityentry, asnentry, members = groups[key]
+            db = self.snapshot(cityentry, asnentry)
+            found = search.batch(db, [items[position][0] for position, when in members], selected)
+            for (position, when), msg in zip(members, found):
+                msg['as_of'] = stamp(when)
+                msg['snapshots'] = {'city': cityentry['time'], 'asn': asnentry['time']}
+                results[position] = msg
+
+        return results
+
+def records(stream, kind, column, moment, at):
+
+    if kind == 'text':
+        for line in stream:
+            line = line.strip()
+            if line != '':
+                ip, _, value = line.partition(',')
+                yield ip.strip(), value.strip() or at
+
+    elif kind == 'csv':
+        for row in csv.DictReader(stream):
+            yield (row.get(column) or '').strip(), row.get(moment) or at
+
+    else:
+        for line in stream:
+            if line.strip() != '':
+                row = json.loads(line)
+                yield str(row.get(column, '')).strip(), row.get(moment) or at
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Look up IP addresses in the GeoLite2 snapshots current at a point in time.')
+    parser.add_argument('addresses', nargs = '*', help = 'addresses to look up as of --at, otherwise rows are read from stdin')
+    parser.add_argument('--at', default = None, help = 'timestamp for addresses and for rows without one')
+    parser.add_argument('--bucket', default = os.environ.get('GEOLITE_RESEARCH', 'geolite-research-lukach-io'), help = 'research bucket holding catalog.json')
+    parser.add_argument('--cache', default = os.environ.get('GEOLITE_HISTORY', os.path.join(os.path.expanduser('~'), '.cache', 'geolite')), help = 'directory caching fetched snapshots')
+    parser.add_argument('--budget', type = int, default = 4096, help = 'snapshot cache size in MiB')
+    parser.add_argument('--format', choices = ['text', 'csv', 'jsonl'], default = 'text', help = 'stdin format, text lines are ip or ip,timestamp')
+    parser.add_argument('--column', default = 'ip', help = 'CSV column or JSONL field holding the address')
+    parser.add_argument('--time', default = 'timestamp', help = 'CSV column or JSONL field holding the timestamp')
+    parser.add_argument('--fields', default = '', help = 'comma separated fields, as the search API fields= parameter')
+    parser.add_argument('--chunk', type = int, default = 5000, help = 'rows per batch')
+    args = parser.parse_args()
+
+    if args.addresses and args.at is None:
+        parser.error('--at is required with addresses')
+
+    selected = search.projection({'fields': args.fields})
+    history = History(args.bucket, args.cache, args.budget * 1048576)
+
+    if args.addresses:
+        rows = ((ip, args.at) for ip in args.addresses)
+    else:
+        rows = records(sys.stdin, args.format, args.column, args.time, args.at)
+
+    chunk = []
+
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == args.chunk:
+            for result in history.batch(chunk, selected):
+                sys.stdout.write(json.dumps(result)+'\n')
+            chunk = []
+
+    if chunk:
+        for result in history.batch(chunk, selected):
+            sys.stdout.write(json.dumps(result)+'\n')
+
+    history.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import ipaddress
+import json
+import math
+import numpy
+
+# Radius and nearest-location queries over the GeoLite2-City.geo.npz grid
+# published by the download pipeline; distances are great-circle kilometers.
+
+RADIUS = 6371.0088
+HALF = math.pi * RADIUS
+
+class LocationIndex:
+
+    def __init__(self, path):
+
+        with numpy.load(path) as data:
+            self.cells = data['cells']
+            self.latitude = data['latitude']
+            self.longitude = data['longitude']
+            self.first = data['first']
+            self.starts = data['starts']
+            self.prefixes = data['prefixes']
+            self.records = json.loads(data['records'].tobytes())
+
+    def candidates(self, latitude, longitude, km):
+
+        # Grid cells inside the bounding box of the circle, widened to every
+        # longitude when the circle reaches a pole.
+
+        delta = km / RADIUS
+        low = math.degrees(math.radians(latitude) - delta)
+        high = math.degrees(math.radians(latitude) + delta)
+
+        if low <= -90 or high >= 90 or math.sin(delta) >= math.cos(math.radians(latitude)):
+            columns = range(360)
+        else:
+            spread = math.degrees(math.asin(math.sin(delta) / math.cos(math.radians(latitude))))
+            columns = [(column + 180) % 360 for column in range(math.floor(longitude - spread), math.floor(longitude + spread) + 1)]
+            columns = sorted(set(columns))
+
+        positions = []
+
+        for row in range(max(math.floor(low), -90) + 90, min(math.floor(high), 89) + 91):
+            for column in columns:
+                start = self.cells[row * 360 + column]
+                end = self.cells[row * 360 + column + 1]
+                if start < end:
+                    positions.append(numpy.arange(start, end))
+
+        if not positions:
+            return numpy.zeros(0, dtype = numpy.int64)
+
+        return numpy.concatenate(positions)
+
+    def distances(self, latitude, longitude, positions):
+
+        lat1 = math.radians(latitude)
+        lat2 = numpy.radians(self.latitude[positions])
+        dlat = lat2 - lat1
+        dlon = numpy.radians(self.longitude[positions] - longitude)
+        a = numpy.sin(dlat / 2) ** 2 + math.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon / 2) ** 2
+
+        return 2 * RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+    def networks(self, position):
+
+        networks = []
+
+        for index in range(self.first[position], self.first[position + 1]):
+            start = int.from_bytes(self.starts[index].ljust(16, b'\x00'), 'big')
+            prefixlen = int(self.prefixes[index])
+            if prefixlen >= 96 and start < 2 ** 32:
+                networks.append(str(ipaddress.IPv4Network((start, prefixlen - 96))))
+            else:
+                networks.append(str(ipaddress.IPv6Network((start, prefixlen))))
+
+        return networks
+
+    def search(self, latitude, longitude, km):
+
+        positions = self.candidates(latitude, longitude, km)
+        distances = self.distances(latitude, longitude, positions)
+        inside = distances <= km
+        positions = positions[inside]
+        distances = distances[inside]
+        order = numpy.argsort(distances, kind = 'stable')
+
+        return positions[order], distances[order]
+
+    def result(self, position, distance):
+
+        return {
+            'distance': round(float(distance), 3),
+            'geo': self.records[position],
+            'networks': self.networks(position)
+        }
+
+    def radius(self, latitude, longitude, km, offset = 0, limit = 100):
+
+        # Locations within km of the point, nearest first, one page at a time.
+
+        positions, distances = self.search(latitude, longitude, km)
+
+        return {
+            'total': len(positions),
+            'results': [self.result(position, distance) for position, distance in zip(positions[offset:offset + limit], distances[offset:offset + limit])]
+        }
+
+    def nearest(self, latitude, longitude, k):
+
+        # Doubles the search radius until it holds k locations; every location
+        # closer than the k-th is inside that radius, so the answer is exact.
+
+        km = 50.0
+
+        while True:
+            positions, distances = self.search(latitude, longitude, km)
+            if len(positions) >= k or km >= HALF:
+                break
+            km = min(km * 2, HALF)
+
+        return [self.result(position, distance) for position, distance in zip(positions[:k], distances[:k])]
@@ -1,4 +1,5 @@
 import datetime
+import json
 
 from aws_cdk import (
     Duration,
@@ -26,7 +27,7 @@ from constructs import Construct
 
 class GeoliteDownload(Stack):
 
-    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, regions: dict, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         account = Stack.of(self).account
@@ -58,6 +59,14 @@ class GeoliteDownload(Stack):
             tier = _ssm.ParameterTier.STANDARD
         )
 
+        packageparameter = _ssm.StringParameter(
+            self, 'packageparameter',
+            parameter_name = '/maxmind/geolite2/package',
+            string_value = 'EMPTY',
+            description = 'MaxMind GeoLite2 Search Package Fingerprint',
+            tier = _ssm.ParameterTier.STANDARD
+        )
+
     ### S3 BUCKETS ###
 
         bucket = _s3.Bucket.from_bucket_name(
@@ -65,15 +74,20 @@ class GeoliteDownload(Stack):
             bucket_name = 'packages-use2-lukach-io'
         )
 
-        use1 = _s3.Bucket.from_bucket_name(
-            self, 'use1',
-            bucket_name = 'geolite-staged-use1-lukach-io'
-        )
+        search = []
 
-        usw2 = _s3.Bucket.from_bucket_name(
-            self, 'usw2',
-            bucket_name = 'geolite-staged-usw2-lukach-io'
-        )
+        for region, code in regions.items():
+
+            regional = _s3.Bucket.from_bucket_name(
+                self, code,
+                bucket_name = 'geolite-staged-'+code+'-lukach-io'
+            )
+
+            search.append({
+                'region': region,
+                'bucket': regional.bucket_name,
+                'function': 'arn:aws:lambda:'+region+':'+str(account)+':function:search'
+            })
 
         staged = _s3.Bucket(
             self, 'staged',
@@ -176,7 +190,7 @@ class GeoliteDownload(Stack):
 
         research.add_to_resource_policy(object_policy_two)
 
-    ### LAMBDA LAYER ###
+    ### LAMBDA LAYERS ###
 
         requests = _lambda.LayerVersion(
             self, 'requests',
@@ -195,6 +209,23 @@ class GeoliteDownload(Stack):
             removal_policy = RemovalPolicy.DESTROY
         )
 
+        numpy = _lambda.LayerVersion(
+            self, 'numpy',
+            layer_version_name = 'numpy',
+            description = str(year)+'-'+str(month)+'-'+str(day)+' deployment',
+            code = _lambda.Code.from_bucket(
+                bucket = bucket,
+                key = 'numpy.zip'
+            ),
+            compatible_architectures = [
+                _lambda.Architecture.ARM_64
+            ],
+            compatible_runtimes = [
+                _lambda.Runtime.PYTHON_3_13
+            ],
+            removal_policy = RemovalPolicy.DESTROY
+        )
+
     ### SECRET MANAGER ###
 
         secret = _secrets.Secret(
@@ -224,9 +255,12 @@ class GeoliteDownload(Stack):
         role.add_to_policy(
             _iam.PolicyStatement(
                 actions = [
+                    'lambda:InvokeFunction',
                     'lambda:UpdateFunctionCode',
                     's3:GetObject',
+                    's3:ListBucket',
                     's3:PutObject',
+                    's3:PutObjectTagging',
                     'ssm:GetParameter',
                     'ssm:PutParameter'
                 ],
@@ -240,6 +274,63 @@ class GeoliteDownload(Stack):
 
     ### LAMBDA FUNCTION ###
 
+        merge = _lambda.Function(
+            self, 'merge',
+            runtime = _lambda.Runtime.PYTHON_3_13,
+            architecture = _lambda.Architecture.ARM_64,
+            code = _lambda.Code.from_asset('download'),
+            handler = 'build.merge',
+            environment = dict(
+                S3_STAGED = staged.bucket_name,
+                SEARCH_REGIONS = json.dumps(search),
+                SEARCH_RELOAD = 'true',
+                SSM_PARAMETER_PACKAGE = '/maxmind/geolite2/package'
+            ),
+            ephemeral_storage_size = Size.gibibytes(10),
+            timeout = Duration.seconds(900),
+            memory_size = 10240,
+            role = role,
+            layers = [
+                numpy,
+                requests
+            ]
+        )
+
+        mergelogs = _logs.LogGroup(
+            self, 'mergelogs',
+            log_group_name = '/aws/lambda/'+merge.function_name,
+            retention = _logs.RetentionDays.ONE_WEEK,
+            removal_policy = RemovalPolicy.DESTROY
+        )
+
+        build = _lambda.Function(
+            self, 'build',
+            runtime = _lambda.Runtime.PYTHON_3_13,
+            architecture = _lambda.Architecture.ARM_64,
+            code = _lambda.Code.from_asset('download'),
+            handler = 'build.handler',
+            environment = dict(
+                MERGE_FUNCTION = merge.function_name,
+                S3_RESEARCH = research.bucket_name,
+                S3_STAGED = staged.bucket_name
+            ),
+            ephemeral_storage_size = Size.gibibytes(10),
+            timeout = Duration.seconds(900),
+            memory_size = 10240,
+            role = role,
+            layers = [
+                numpy,
+                requests
+            ]
+        )
+
+        buildlogs = _logs.LogGroup(
+            self, 'buildlogs',
+            log_group_name = '/aws/lambda/'+build.function_name,
+            retention = _logs.RetentionDays.ONE_WEEK,
+            removal_policy = RemovalPolicy.DESTROY
+        )
+
         download = _lambda.Function(
             self, 'download',
             runtime = _lambda.Runtime.PYTHON_3_13,
@@ -247,19 +338,17 @@ class GeoliteDownload(Stack):
             code = _lambda.Code.from_asset('download'),
             handler = 'download.handler',
             environment = dict(
+                BUILD_FUNCTION = build.function_name,
                 S3_RESEARCH = research.bucket_name,
                 S3_STAGED = staged.bucket_name,
-                S3_USE1 = use1.bucket_name,
-                S3_USW2 = usw2.bucket_name,
                 SECRET_MGR_ARN = secret.secret_arn,
                 SSM_PARAMETER_ASN = '/maxmind/geolite2/asn',
                 SSM_PARAMETER_CITY = '/maxmind/geolite2/city',
-                LAMBDA_FUNCTION_USE1 = 'arn:aws:lambda:us-east-1:'+str(account)+':function:search',
-                LAMBDA_FUNCTION_USW2 = 'arn:aws:lambda:us-west-2:'+str(account)+':function:search'
+                SSM_PARAMETER_PACKAGE = '/maxmind/geolite2/package'
             ),
-            ephemeral_storage_size = Size.gibibytes(1),
+            ephemeral_storage_size = Size.mebibytes(512),
             timeout = Duration.seconds(900),
-            memory_size = 2048,
+            memory_size = 1024,
             role = role,
             layers = [
                 requests
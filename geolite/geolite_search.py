@@ -3,6 +3,7 @@ import datetime
 from aws_cdk import (
     Duration,
     RemovalPolicy,
+    Size,
     Stack,
     aws_iam as _iam,
     aws_lambda as _lambda,
@@ -13,9 +14,9 @@ from aws_cdk import (
 
 from constructs import Construct
 
-class GeoliteSearchUSE1(Stack):
+class GeoliteSearch(Stack):
 
-    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, code: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         year = datetime.datetime.now().strftime('%Y')
@@ -33,18 +34,25 @@ class GeoliteSearchUSE1(Stack):
 
         bucket = _s3.Bucket.from_bucket_name(
             self, 'bucket',
-            bucket_name = 'packages-use1-lukach-io'
+            bucket_name = 'packages-'+code+'-lukach-io'
         )
 
         staged = _s3.Bucket(
             self, 'staged',
-            bucket_name = 'geolite-staged-use1-lukach-io',
+            bucket_name = 'geolite-staged-'+code+'-lukach-io',
             encryption = _s3.BucketEncryption.S3_MANAGED,
             block_public_access = _s3.BlockPublicAccess.BLOCK_ALL,
             removal_policy = RemovalPolicy.DESTROY,
             auto_delete_objects = True,
             enforce_ssl = True,
-            versioned = False
+            versioned = False,
+            lifecycle_rules = [
+                _s3.LifecycleRule(
+                    prefix = 'versions/',
+                    tag_filters = {'retired': 'true'},
+                    expiration = Duration.days(7)
+                )
+            ]
         )
 
     ### LAMBDA LAYERS ###
@@ -83,6 +91,40 @@ class GeoliteSearchUSE1(Stack):
             removal_policy = RemovalPolicy.DESTROY
         )
 
+        msgpack = _lambda.LayerVersion(
+            self, 'msgpack',
+            layer_version_name = 'msgpack',
+            description = str(year)+'-'+str(month)+'-'+str(day)+' deployment',
+            code = _lambda.Code.from_bucket(
+                bucket = bucket,
+                key = 'msgpack.zip'
+            ),
+            compatible_architectures = [
+                _lambda.Architecture.ARM_64
+            ],
+            compatible_runtimes = [
+                _lambda.Runtime.PYTHON_3_13
+            ],
+            removal_policy = RemovalPolicy.DESTROY
+        )
+
+        cbor2 = _lambda.LayerVersion(
+            self, 'cbor2',
+            layer_version_name = 'cbor2',
+            description = str(year)+'-'+str(month)+'-'+str(day)+' deployment',
+            code = _lambda.Code.from_bucket(
+                bucket = bucket,
+                key = 'cbor2.zip'
+            ),
+            compatible_architectures = [
+                _lambda.Architecture.ARM_64
+            ],
+            compatible_runtimes = [
+                _lambda.Runtime.PYTHON_3_13
+            ],
+            removal_policy = RemovalPolicy.DESTROY
+        )
+
     ### IAM ROLE ###
 
         role = _iam.Role(
@@ -118,15 +160,26 @@ class GeoliteSearchUSE1(Stack):
             architecture = _lambda.Architecture.ARM_64,
             code = _lambda.Code.from_asset('search'),
             handler = 'search.handler',
+            environment = dict(
+                GEOLITE_BUCKET = staged.bucket_name,
+                GEOLITE_ENGINE = 'direct',
+                GEOLITE_MODE = 'auto',
+                GEOLITE_RELOAD = '300'
+            ),
+            ephemeral_storage_size = Size.gibibytes(1),
             timeout = Duration.seconds(7),
             memory_size = 128,
             role = role,
             layers = [
                 geoip2,
-                maxminddb
+                maxminddb,
+                msgpack,
+                cbor2
             ]
         )
 
+        staged.grant_read(role)
+
         composite = _iam.CompositePrincipal(
             _iam.OrganizationPrincipal(organization.string_value),
             _iam.ServicePrincipal('apigateway.amazonaws.com')
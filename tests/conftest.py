@@ -0,0 +1,53 @@
+import ipaddress
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'download'))
+
+import direct
+import mmdb
+import reverse
+
+CITIES = [
+    ('1.0.0.0/24', 'Fargo'),
+    ('1.8.0.0/13', 'Moorhead'),
+    ('1.16.0.0/12', 'Bismarck'),
+    ('8.8.8.0/24', 'Mountain View'),
+    ('8.8.9.0/24', 'Mountain View'),
+    ('2600:1f00::/32', 'Grand Forks')
+]
+
+ASNS = [
+    ('1.0.0.0/10', 124),
+    ('8.8.0.0/16', 15169),
+    ('2600:1f00::/40', 64496)
+]
+
+def write(path, entries, record):
+
+    writer = mmdb.Writer()
+
+    for cidr, value in entries:
+        network = ipaddress.ip_network(cidr)
+        prefixlen = network.prefixlen + (96 if network.version == 4 else 0)
+        writer.insert(int(network.network_address), prefixlen, writer.store(record(value)))
+
+    writer.write(path, 'Test', 'Test')
+
+@pytest.fixture
+def path(tmp_path):
+
+    write(str(tmp_path / 'GeoLite2-City.mmdb'), CITIES, lambda name: {'city': {'names': {'en': name}}})
+    write(str(tmp_path / 'GeoLite2-ASN.mmdb'), ASNS, lambda number: {'autonomous_system_number': number, 'autonomous_system_organization': 'ORG '+str(number)})
+
+    mmdb.merge(str(tmp_path / 'GeoLite2-City.mmdb'), str(tmp_path / 'GeoLite2-ASN.mmdb'), str(tmp_path / 'GeoLite2-Merged.mmdb'))
+    direct.build(str(tmp_path / 'GeoLite2-City.mmdb'), str(tmp_path / 'GeoLite2-ASN.mmdb'), str(tmp_path / 'GeoLite2-IPv4.dir'))
+    reverse.build(str(tmp_path / 'GeoLite2-ASN.mmdb'), str(tmp_path / 'GeoLite2-ASN.rev'))
+
+    (tmp_path / 'city.updated').write_text(str(tmp_path)+' city')
+    (tmp_path / 'asn.updated').write_text(str(tmp_path)+' asn')
+
+    return str(tmp_path)
+
@@ -0,0 +1,43 @@
+import ipaddress
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'enrich'))
+
+import bulk
+import ranges
+import search
+
+ADDRESSES = [
+    '1.11.52.0',
+    '::ffff:1.11.52.0',
+    '::1.11.52.0',
+    '2002:10b:3400::1',
+    '::ffff:1.17.0.1',
+    '2002:808:808::',
+    '2600:1f00::1',
+    '10.0.0.1',
+    'junk'
+]
+
+def test_bulk_matches_search_batch(path):
+
+    for name in ('City', 'ASN'):
+        ranges.build(os.path.join(path, 'GeoLite2-'+name+'.mmdb'), os.path.join(path, 'GeoLite2-'+name+'.npz'))
+
+    city = bulk.RangeIndex(os.path.join(path, 'GeoLite2-City.npz'))
+    asn = bulk.RangeIndex(os.path.join(path, 'GeoLite2-ASN.npz'))
+    db = search.Databases(path, 'mmap')
+
+    expected = search.batch(db, ADDRESSES)
+
+    assert bulk.lookup(city, asn, ADDRESSES) == expected
+    assert expected[3]['geo']['city'] == 'Moorhead'
+
+    addresses = [ipaddress.ip_address(address) for address in ADDRESSES if address != 'junk']
+    addresses = [str(ip) for ip in sorted(addresses, key = lambda ip: (ip.version, int(ip)))]
+
+    assert list(bulk.join(city, asn, addresses)) == search.batch(db, addresses)
+
+    db.close()
@@ -0,0 +1,47 @@
+import gzip
+import json
+
+import conftest
+import delta
+
+OLD = [
+    ('1.0.0.0/24', 'Fargo'),
+    ('1.0.1.0/24', 'Moorhead'),
+    ('1.1.0.0/24', 'Bismarck'),
+    ('8.8.8.0/24', 'Mountain View')
+]
+
+NEW = [
+    ('1.0.0.0/24', 'Fargo'),
+    ('1.1.0.0/23', 'Bismarck'),
+    ('8.8.8.0/24', 'Sunnyvale'),
+    ('9.0.0.0/24', 'Minot'),
+    ('9.0.1.0/24', 'Minot')
+]
+
+def test_delta_classifies_and_merges_ranges(tmp_path):
+
+    record = lambda name: {'city': {'names': {'en': name}}}
+    conftest.write(str(tmp_path / 'old.mmdb'), OLD, record)
+    conftest.write(str(tmp_path / 'new.mmdb'), NEW, record)
+
+    count = delta.build(str(tmp_path / 'old.mmdb'), str(tmp_path / 'new.mmdb'), str(tmp_path / 'delta.jsonl.gz'), 'GeoLite2-City', 'then', 'now')
+
+    with gzip.open(str(tmp_path / 'delta.jsonl.gz'), 'rt') as f:
+        lines = [json.loads(line) for line in f]
+
+    assert lines[0] == {'database': 'GeoLite2-City', 'from': 'then', 'to': 'now'}
+    assert count == len(lines) - 1
+
+    found = [(line['change'], line['networks'], (line['old'] or {}).get('city'), (line['new'] or {}).get('city')) for line in lines[1:]]
+
+    # The two Minot networks are adjacent with the same change and record,
+    # so they come back as one line covering 9.0.0.0/23.
+
+    assert found == [
+        ('removed', ['1.0.1.0/24'], 'Moorhead', None),
+        ('resized', ['1.1.0.0/24'], 'Bismarck', 'Bismarck'),
+        ('added', ['1.1.1.0/24'], None, 'Bismarck'),
+        ('changed', ['8.8.8.0/24'], 'Mountain View', 'Sunnyvale'),
+        ('added', ['9.0.0.0/23'], None, 'Minot')
+    ]
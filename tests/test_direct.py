@@ -0,0 +1,76 @@
+import ipaddress
+import os
+import struct
+import sys
+
+import maxminddb
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+import conftest
+import direct
+import search
+
+def test_direct_matches_source_databases(path):
+
+    table = search.Direct(os.path.join(path, 'GeoLite2-IPv4.dir'))
+    city = maxminddb.open_database(os.path.join(path, 'GeoLite2-City.mmdb'))
+    asn = maxminddb.open_database(os.path.join(path, 'GeoLite2-ASN.mmdb'))
+
+    for value in range(0x01000000, 0x09000000, 0x00010001):
+        ip = ipaddress.IPv4Address(value)
+        found = table.get(ip)
+
+        record, prefixlen = city.get_with_prefix_len(ip)
+        if record is None:
+            assert found is None or found[0] is None
+        else:
+            assert found[0]['city'] == record['city']['names']['en']
+            assert found[1] == prefixlen
+
+        record, prefixlen = asn.get_with_prefix_len(ip)
+        if record is None:
+            assert found is None or found[2] is None
+        else:
+            assert found[2]['id'] == record['autonomous_system_number']
+            assert found[3] == prefixlen
+
+    table.close()
+    city.close()
+    asn.close()
+
+def test_direct_stores_each_record_once(path):
+
+    # Mountain View holds two networks and Fargo, Moorhead and Bismarck
+    # share one ASN, so four City and two ASN records cover every network.
+
+    with open(os.path.join(path, 'GeoLite2-IPv4.dir'), 'rb') as f:
+        magic, groups, patterns, palette, entries, records = struct.unpack('<8sIIIII', f.read(28))
+
+    assert records == 4 + 2
+    assert patterns <= groups
+
+def test_direct_splits_blocks_below_24(tmp_path):
+
+    # Two /24 blocks split at the same boundaries share one slot pattern
+    # and keep their own palettes.
+
+    cities = [('9.0.0.0/25', 'Fargo'), ('9.0.0.128/26', 'Moorhead'), ('9.0.1.0/25', 'Bismarck'), ('9.0.1.128/26', 'Minot')]
+    conftest.write(str(tmp_path / 'GeoLite2-City.mmdb'), cities, lambda name: {'city': {'names': {'en': name}}})
+    conftest.write(str(tmp_path / 'GeoLite2-ASN.mmdb'), [('9.0.0.0/23', 64500)], lambda number: {'autonomous_system_number': number})
+    direct.build(str(tmp_path / 'GeoLite2-City.mmdb'), str(tmp_path / 'GeoLite2-ASN.mmdb'), str(tmp_path / 'GeoLite2-IPv4.dir'))
+
+    with open(str(tmp_path / 'GeoLite2-IPv4.dir'), 'rb') as f:
+        magic, groups, patterns, palette, entries, records = struct.unpack('<8sIIIII', f.read(28))
+
+    assert (groups, patterns) == (2, 1)
+
+    table = search.Direct(str(tmp_path / 'GeoLite2-IPv4.dir'))
+
+    for address, name, prefixlen in [('9.0.0.1', 'Fargo', 25), ('9.0.0.130', 'Moorhead', 26), ('9.0.0.200', None, None), ('9.0.1.127', 'Bismarck', 25), ('9.0.1.191', 'Minot', 26), ('9.0.1.192', None, None)]:
+        found = table.get(ipaddress.ip_address(address))
+        assert found[2]['id'] == 64500 and found[3] == 23, address
+        assert (found[0] or {}).get('city') == name, address
+        assert (found[1] if found[0] else None) == prefixlen, address
+
+    table.close()
@@ -0,0 +1,38 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'enrich'))
+
+import enrich
+
+def test_bad_jsonl_lines_become_errors():
+
+    stream = io.StringIO('{"ip": "8.8.8.8"}\nnot json\n[1]\n\n{"x": 2}\n{"ip": "1.0.0.1"}\n')
+
+    assert list(enrich.records(stream, 'jsonl', 'ip')) == [
+        ({'ip': '8.8.8.8'}, '8.8.8.8', None),
+        (None, None, 'line 2: invalid JSON'),
+        (None, None, 'line 3: not a JSON object'),
+        ({'x': 2}, None, 'line 5: no ip field'),
+        ({'ip': '1.0.0.1'}, '1.0.0.1', None)
+    ]
+
+def test_short_csv_rows_become_errors():
+
+    stream = io.StringIO('id,src_ip\n1,8.8.8.8\n2\n3,1.0.0.1\n')
+
+    assert list(enrich.records(stream, 'csv', 'src_ip')) == [
+        (['id', 'src_ip'], None, None),
+        (['1', '8.8.8.8'], '8.8.8.8', None),
+        (['2'], None, 'line 3: no src_ip column'),
+        (['3', '1.0.0.1'], '1.0.0.1', None)
+    ]
+
+def test_unknown_csv_column_is_reported():
+
+    with pytest.raises(ValueError, match = 'no ip column, columns are id, src_ip'):
+        next(enrich.records(io.StringIO('id,src_ip\n1,8.8.8.8\n'), 'csv', 'ip'))
@@ -0,0 +1,103 @@
+import ipaddress
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+import search
+
+@pytest.fixture
+def db(path, monkeypatch):
+
+    databases = search.Databases(path, 'mmap')
+
+    monkeypatch.setenv('AWS_REGION', 'us-east-2')
+    monkeypatch.setattr(search, 'databases', databases)
+
+    yield databases
+
+    databases.close()
+
+def get(query):
+
+    return search.handler({
+        'rawQueryString': query,
+        'requestContext': {'http': {'method': 'GET', 'sourceIp': '8.8.8.8'}}
+    }, None)
+
+def test_org_limit_is_at_least_one(db):
+
+    for limit in ('0', '-5', '1'):
+        response = get('org=org&limit='+limit)
+        assert response['statusCode'] == 200
+        assert len(json.loads(response['body'])['matches']) == 1
+
+    assert len(json.loads(get('org=org')['body'])['matches']) == 3
+
+def test_blank_org_is_rejected(db):
+
+    assert get('org=')['statusCode'] == 400
+    assert get('org=&limit=5')['statusCode'] == 400
+
+def test_bare_address(db):
+
+    assert json.loads(get('1.12.64.0')['body'])['ip'] == '1.12.64.0'
+    assert json.loads(get('ip=1.12.64.0&format=compact')['body'])['ip'] == '1.12.64.0'
+    assert json.loads(get('')['body'])['ip'] == '8.8.8.8'
+
+def test_subnets_merge_adjacent_leaves(db):
+
+    body = json.loads(get('1.0.0.0/8')['body'])
+    pieces = [(piece['first'], piece['last'], piece['geo']['city'], piece['asn']['net']) for piece in body['networks']]
+
+    assert pieces == [
+        ('1.0.0.0', '1.0.0.255', 'Fargo', '1.0.0.0/10'),
+        ('1.0.1.0', '1.7.255.255', None, '1.0.0.0/10'),
+        ('1.8.0.0', '1.15.255.255', 'Moorhead', '1.0.0.0/10'),
+        ('1.16.0.0', '1.31.255.255', 'Bismarck', '1.0.0.0/10'),
+        ('1.32.0.0', '1.63.255.255', None, '1.0.0.0/10')
+    ]
+    assert body['next'] is None
+
+    body = json.loads(get('8.8.8.128/25')['body'])
+    assert [(piece['first'], piece['last']) for piece in body['networks']] == [('8.8.8.128', '8.8.8.255')]
+
+    assert len(json.loads(get('2600:1f00::/32')['body'])['networks']) == 2
+
+def test_subnets_pages_resume_at_next(db):
+
+    whole = json.loads(get('1.0.0.0/8')['body'])['networks']
+    pages = []
+    query = '1.0.0.0/8&limit=2'
+
+    while True:
+        body = json.loads(get(query)['body'])
+        pages += body['networks']
+        if body['next'] is None:
+            break
+        query = '1.0.0.0/8&limit=2&start='+body['next']
+
+    assert pages == whole
+
+def test_subnets_reject_empty_cidr(db):
+
+    assert get('cidr=')['statusCode'] == 400
+    assert get('cidr=&limit=5')['statusCode'] == 400
+
+def test_tree_walk_from_start(db):
+
+    network = ipaddress.ip_network('1.0.0.0/8')
+    leaves = [leaf for leaf, record in db.tree.walk(network, int(network.network_address))]
+
+    assert leaves == sorted(leaves)
+    assert all(leaf.subnet_of(network) for leaf in leaves)
+
+    for leaf in leaves:
+        for start in (leaf.network_address, leaf.broadcast_address):
+            assert [found for found, record in db.tree.walk(network, int(start))] == [other for other in leaves if other.broadcast_address >= start]
+
+    network = ipaddress.ip_network('8.8.8.128/25')
+    assert [leaf for leaf, record in db.tree.walk(network, int(network.network_address))] == [ipaddress.ip_network('8.8.8.0/24')]
@@ -0,0 +1,62 @@
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'enrich'))
+
+import conftest
+import locations
+import spatial
+
+# Pairs of places close together across the north pole and across the
+# antimeridian, which fall in grid cells far apart, plus Fargo.
+
+PLACES = [
+    ('1.0.0.0/24', ('Fargo', 46.8772, -96.7898)),
+    ('1.0.1.0/24', ('Alert', 89.5, 10.0)),
+    ('1.0.2.0/24', ('Barneo', 89.5, -170.0)),
+    ('1.0.3.0/24', ('Taveuni', -16.8, 179.95)),
+    ('1.0.4.0/24', ('Rabi', -16.8, -179.95))
+]
+
+def distance(a, b):
+
+    lat1, lon1, lat2, lon2 = map(math.radians, a + b)
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * locations.RADIUS * math.asin(math.sqrt(h))
+
+def index(tmp_path):
+
+    conftest.write(str(tmp_path / 'GeoLite2-City.mmdb'), PLACES, lambda place: {
+        'city': {'names': {'en': place[0]}},
+        'location': {'latitude': place[1], 'longitude': place[2]}
+    })
+    spatial.build(str(tmp_path / 'GeoLite2-City.mmdb'), str(tmp_path / 'GeoLite2-City.geo.npz'))
+
+    return locations.LocationIndex(str(tmp_path / 'GeoLite2-City.geo.npz'))
+
+def test_radius_across_pole_and_antimeridian(tmp_path):
+
+    table = index(tmp_path)
+
+    found = table.radius(89.9, 120.0, 150)
+    assert [result['geo']['city'] for result in found['results']] == ['Barneo', 'Alert']
+    assert found['total'] == 2
+    assert abs(found['results'][0]['distance'] - distance((89.9, 120.0), (89.5, -170.0))) < 0.01
+
+    found = table.radius(-16.8, 179.99, 20)
+    assert [result['geo']['city'] for result in found['results']] == ['Taveuni', 'Rabi']
+    assert found['results'][1]['networks'] == ['1.0.4.0/24']
+
+    assert table.radius(46.8772, -96.7898, 1)['results'][0]['distance'] == 0.0
+    assert table.radius(46.8772, -96.7898, 100, offset = 1)['results'] == []
+
+def test_nearest_matches_brute_force(tmp_path):
+
+    table = index(tmp_path)
+
+    for point in [(89.99, -60.0), (-16.8, -179.99), (0.0, 0.0), (46.0, -97.0)]:
+        expected = sorted(PLACES, key = lambda place: distance(point, place[1][1:]))
+        found = table.nearest(point[0], point[1], 3)
+        assert [result['geo']['city'] for result in found] == [place[1][0] for place in expected[:3]], point
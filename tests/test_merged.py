@@ -0,0 +1,86 @@
+import ipaddress
+import os
+import sys
+
+import maxminddb
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+import search
+
+ADDRESSES = [
+    '1.12.64.0',
+    '1.13.16.0',
+    '1.0.0.1',
+    '1.17.0.1',
+    '1.40.0.1',
+    '8.8.8.8',
+    '8.8.9.9',
+    '2600:1f00::1',
+    '2600:1f00:100::1'
+]
+
+def expected(reader, ip):
+
+    record, prefixlen = reader.get_with_prefix_len(ip)
+
+    return record, ipaddress.ip_network((ip, prefixlen), strict = False)
+
+def forms(address):
+
+    ip = ipaddress.ip_address(address)
+
+    if ip.version == 6:
+        return [ip]
+
+    return [
+        ip,
+        ipaddress.ip_address('::ffff:'+address),
+        ipaddress.ip_address((0x2002 << 112) | (int(ip) << 80) | 1)
+    ]
+
+def test_merged_matches_source_databases(path):
+
+    # Every address is looked up twice in each form, so the second pass is
+    # answered from warm network caches keyed by the networks of the first.
+
+    db = search.Databases(path, 'mmap')
+    city = maxminddb.open_database(os.path.join(path, 'GeoLite2-City.mmdb'))
+    asn = maxminddb.open_database(os.path.join(path, 'GeoLite2-ASN.mmdb'))
+
+    assert db.merged is not None
+
+    for _ in range(2):
+        for address in ADDRESSES:
+            for ip in forms(address):
+
+                georecord, cidr, asnrecord, net = search.lookup(db, ip)
+                record, network = expected(city, ip)
+                assert georecord['city'] == (record or {}).get('city', {}).get('names', {}).get('en'), ip
+                if record is not None:
+                    assert cidr == network, ip
+                    assert georecord['cidr'] == str(network), ip
+
+                record, network = expected(asn, ip)
+                assert asnrecord['id'] == (record or {}).get('autonomous_system_number'), ip
+                if record is not None:
+                    assert net == network, ip
+                    assert asnrecord['net'] == str(network), ip
+
+    city.close()
+    asn.close()
+    db.close()
+
+def test_mapped_network_in_ipv6_space(path):
+
+    db = search.Databases(path, 'mmap')
+
+    georecord, cidr, asnrecord, net = search.lookup(db, ipaddress.ip_address('::ffff:1.12.64.0'))
+    assert georecord['cidr'] == '::ffff:108:0/109'
+    assert asnrecord['net'] == '::ffff:100:0/106'
+
+    georecord, cidr, asnrecord, net = search.lookup(db, ipaddress.ip_address('2002:110:1::'))
+    assert georecord['city'] == 'Bismarck'
+    assert georecord['cidr'] == '2002:110::/28'
+
+    db.close()
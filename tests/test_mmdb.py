@@ -0,0 +1,52 @@
+import ipaddress
+
+import maxminddb
+
+import conftest
+import mmdb
+
+# Teredo and 6to4 carry the IPv4 address at bit 32 and bit 16 of the IPv6
+# address, the mapped and NAT64 blocks in the last 32 bits.
+
+NAT64 = (0x64ff9b << 96, 96)
+
+FORMS = [
+    lambda v4: v4,
+    lambda v4: (0xffff << 32) | v4,
+    lambda v4: (0x2001 << 112) | (v4 << 64),
+    lambda v4: (0x2002 << 112) | (v4 << 80),
+    lambda v4: NAT64[0] | v4
+]
+
+def test_rewrite_and_merge_keep_source_aliases(tmp_path):
+
+    writer = mmdb.Writer()
+    for cidr, name in conftest.CITIES:
+        network = ipaddress.ip_network(cidr)
+        prefixlen = network.prefixlen + (96 if network.version == 4 else 0)
+        writer.insert(int(network.network_address), prefixlen, writer.store({'city': {'names': {'en': name}}}))
+    writer.write(str(tmp_path / 'source.mmdb'), 'Test', 'Test', mmdb.ALIASES + (NAT64,))
+
+    conftest.write(str(tmp_path / 'asn.mmdb'), conftest.ASNS, lambda number: {'autonomous_system_number': number})
+
+    mmdb.rewrite(str(tmp_path / 'source.mmdb'), str(tmp_path / 'slim.mmdb'), mmdb.slim)
+    mmdb.merge(str(tmp_path / 'source.mmdb'), str(tmp_path / 'asn.mmdb'), str(tmp_path / 'merged.mmdb'))
+
+    source = maxminddb.open_database(str(tmp_path / 'source.mmdb'))
+    slim = maxminddb.open_database(str(tmp_path / 'slim.mmdb'))
+    merged = maxminddb.open_database(str(tmp_path / 'merged.mmdb'))
+
+    for address in ['1.0.0.1', '1.12.64.0', '8.8.9.9']:
+        v4 = int(ipaddress.ip_address(address))
+        for form in FORMS:
+            ip = ipaddress.ip_address(form(v4))
+            record, prefixlen = source.get_with_prefix_len(ip)
+            assert record is not None, ip
+            assert slim.get_with_prefix_len(ip) == (record, prefixlen), ip
+            found, leaf = merged.get_with_prefix_len(ip)
+            assert found['city'] == record, ip
+            assert leaf - found['city_delta'] == prefixlen, ip
+
+    source.close()
+    slim.close()
+    merged.close()